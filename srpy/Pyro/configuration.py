@@ -56,13 +56,21 @@ _defaults= {
 	'PYRO_STDLOGGING':		0,
 	'PYRO_STDLOGGING_CFGFILE': 'logging.cfg',
 	'PYRO_MAXCONNECTIONS':	200,
+	'PYRO_SERVER_MODE':		'threaded',	# threaded: a thread per connection, eventloop: see TCPServer
+	'PYRO_SERVER_WORKERS':	16,		# worker threads of the eventloop mode
 	'PYRO_TCP_LISTEN_BACKLOG':   200,
 	'PYRO_BROKEN_MSGWAITALL':   0,
 	'PYRO_MULTITHREADED':	1,							# assume 1
 	'PYRO_COMPRESSION':		0,
+	'PYRO_COMPRESSION_CODEC':	'zlib',	# zlib, bz2 or lzma
+	'PYRO_COMPRESSION_LEVEL':	6,
+	'PYRO_COMPRESSION_THRESHOLD':	1024,	# bytes, smaller bodies go as they are
+	'PYRO_COMPRESSION_PROBE':	4096,	# bytes of the compressibility sample
 	'PYRO_MOBILE_CODE':		0,
 	'PYRO_DNS_URI':			0,
 	'PYRO_CHECKSUM':		0,
+	'PYRO_OOB_THRESHOLD':	65536,	# bytes, 0 disables out-of-band buffers
+	'PYRO_SERIALIZER':		'pickle',	# requests: pickle, marshal (lowest latency, trusted hosts) or binary (compact, slower)
 	'PYRO_SOCK_KEEPALIVE':	1,
 	'PYRO_ES_QUEUESIZE':	1000,
 	'PYRO_ES_BLOCKQUEUE':	1,
@@ -417,6 +417,12 @@ class DynamicProxy:
 		self.adapter.setOneway(methods)
 	def _setTimeout(self,timeout):
 		self.adapter.setTimeout(timeout)
+	def _setSerializer(self,name):
+		self.adapter.setSerializer(name)
+	def _setCompression(self,policy):
+		self.adapter.setCompression(policy)
+	def _getCompressionStats(self):
+		return self.adapter.getCompressionStats()
 	def _transferThread(self, newOwnerThread=None):
 		pass # dummy function to retain API compatibility with Pyro 3.7
 	def _release(self):
@@ -427,6 +433,8 @@ class DynamicProxy:
 		proxyCopy.adapter.setIdentification(self.adapter.getIdentification(), munge=False)   # copy identification info
 		proxyCopy._setTimeout(self.adapter.timeout)
 		proxyCopy._setOneway(self.adapter.onewayMethods)
+		proxyCopy._setSerializer(self.adapter.serializer)
+		proxyCopy._setCompression(self.adapter.compression)
 		proxyCopy._setNewConnectionValidator(self.adapter.getNewConnectionValidator())
 		return proxyCopy
 	def __deepcopy__(self, arg):
@@ -460,6 +468,11 @@ class DynamicProxy:
 		if not self.adapter.connected():
 			self.adapter.bindToURI(self.URI)
 		return self.adapter.remoteInvocation(name, Pyro.constants.RIF_VarargsAndKeywords, vargs, kargs)
+	def _pipeline(self, calls):
+		# calls: [(name, vargs, kargs)], see PYROAdapter.pipelineInvocation
+		if not self.adapter.connected():
+			self.adapter.bindToURI(self.URI)
+		return self.adapter.pipelineInvocation([(name, Pyro.constants.RIF_VarargsAndKeywords, (vargs, kargs)) for name,vargs,kargs in calls])
 
 	# Pickling support, otherwise pickle uses __getattr__:
 	def __getstate__(self):
@@ -9,7 +9,7 @@
 #############################################################################
 
 import socket, struct, os, time, sys, hmac, types, random, errno, select
-import imp, marshal, new, __builtin__
+import imp, marshal, new, __builtin__, itertools, cStringIO
 try:
 	import hashlib
 	md5=hashlib.md5
@@ -157,6 +157,26 @@ def sock_sendmsg(sock,msg,timeout=0):
 		raise ConnectionClosedError('connection lost')
 
 
+# Receive exactly size bytes from a socket directly into a writable buffer,
+# without allocating intermediate strings. Same error handling as sock_recvmsg.
+def sock_recvinto(sock, buf, size, timeout=0):
+	view=memoryview(buf)
+	received=0
+	while received<size:
+		try:
+			_sock_timeout_recv(sock,timeout)
+			chunk=sock.recv_into(view[received:], size-received)
+		except socket.timeout:
+			raise TimeoutError("connection timeout receiving")
+		except socket.error,x:
+			if x.args[0] == errno.EINTR or (hasattr(errno, 'WSAEINTR') and x.args[0] == errno.WSAEINTR):
+				continue
+			raise ConnectionClosedError('connection lost: %s' % x)
+		if not chunk:
+			raise ConnectionClosedError('connection lost')
+		received+=chunk
+
+
 # set socket option to try to re-use a server port if possible
 def set_reuse_addr(sock):
 	if os.name not in ('nt','dos','ce') and sys.platform!='cygwin':
@@ -183,6 +203,442 @@ def set_sock_keepalive(sock):
 PFLG_COMPRESSED = 0x01		# protocol flag: compressed body
 PFLG_CHECKSUM =   0x02		# protocol flag: checksum body
 PFLG_XMLPICKLE_GNOSIS =  0x04		# protocol flag: used xml pickling (Gnosis)
+PFLG_OOB =        0x08		# protocol flag: out-of-band buffers follow the body
+
+
+#------ Out-of-band buffers: NumPy arrays and strings of at least
+#------ PYRO_OOB_THRESHOLD bytes are left out of the pickle. They are sent
+#------ after the message body straight from their own memory, and the
+#------ receiver reads them directly into newly allocated arrays/strings.
+#------ Framing after the body: !L descriptor size, pickled descriptors,
+#------ then the raw buffers. Compression and checksums only cover the body.
+#------ Messages are first pickled looking only at the objects cPickle has
+#------ no builtin support for (inst_persistent_id), or with plain dumps if
+#------ numpy is not loaded, so plain data pickles at C speed. They are
+#------ pickled again looking at every object only when the body is long
+#------ enough to hold a long str.
+
+class _OOBBody(str):
+	# message body that carries the out-of-band buffers received with it
+	pass
+
+def _holdsLongStr(obj, threshold, depth=8, width=64):
+	# true if a str of at least threshold bytes is among the first width
+	# items of the builtin containers in obj, down to depth levels
+	t=type(obj)
+	if t is str:
+		return len(obj)>=threshold
+	if not depth:
+		return False
+	if t is dict:
+		items=obj.itervalues()
+	elif t is tuple or t is list:
+		items=obj
+	else:
+		return False
+	for item in itertools.islice(items, width):
+		if _holdsLongStr(item, threshold, depth-1, width):
+			return True
+	return False
+
+def _dumpsOOB(obj):
+	# returns (pickled body, [(descriptor, data)] or None)
+	threshold=Pyro.config.PYRO_OOB_THRESHOLD
+	if not threshold or Pyro.config.PYRO_XML_PICKLE:
+		return pickle.dumps(obj,Pyro.config.PYRO_PICKLE_FORMAT), None
+	numpy=sys.modules.get('numpy')
+	buffers=[]
+	ids={}
+	def persistent_id(o):
+		if type(o) is str:
+			if len(o)<threshold: return None
+			descriptor=('s', len(o))
+		elif numpy is not None and type(o) is numpy.ndarray:
+			if o.nbytes<threshold or o.dtype.hasobject or o.dtype.fields:
+				return None
+			descriptor=('a', o.dtype.str, o.shape)
+		else:
+			return None
+		# keyed on the original object, the contiguous copy is a new one
+		key=id(o)
+		if key not in ids:
+			ids[key]=str(len(buffers))
+			if descriptor[0]=='a': o=numpy.ascontiguousarray(o)
+			buffers.append((descriptor, o))
+		return ids[key]
+	if numpy is None:
+		body=pickle.dumps(obj,Pyro.config.PYRO_PICKLE_FORMAT)
+	else:
+		f=cStringIO.StringIO()
+		pickler=pickle.Pickler(f,Pyro.config.PYRO_PICKLE_FORMAT)
+		pickler.inst_persistent_id=persistent_id
+		pickler.dump(obj)
+		body=f.getvalue()
+	if len(body)>=threshold and _holdsLongStr(obj, threshold):
+		# the long strs went inline, pickle again leaving them out
+		del buffers[:]
+		ids.clear()
+		f=cStringIO.StringIO()
+		pickler=pickle.Pickler(f,Pyro.config.PYRO_PICKLE_FORMAT)
+		pickler.persistent_id=persistent_id
+		pickler.dump(obj)
+		body=f.getvalue()
+	return body, buffers or None
+
+def _loadsOOB(body):
+	buffers=getattr(body,'oobBuffers',None)
+	if buffers is None:
+		return pickle.loads(body)
+	unpickler=pickle.Unpickler(cStringIO.StringIO(body))
+	unpickler.persistent_load=lambda pid: buffers[int(pid)]
+	return unpickler.load()
+
+def _unpackBody(body, pflags, crc):
+	# checks and decompresses a message body, for clients that don't use
+	# receiveMsg (srpyasync)
+	if pflags&PFLG_CHECKSUM:
+		if not _has_compression:
+			raise ProtocolError('cannot perform checksum')
+		if crc!=zlib.adler32(body):
+			raise ProtocolError('checksum error')
+	if pflags&PFLG_COMPRESSED:
+		codec=_codecNames.get(pflags&PFLG_CODEC)
+		if codec is None:
+			raise ProtocolError('compression not supported')
+		body=_codecs[codec][2](body)
+	return body
+
+def _sendOOB(sock, buffers, timeout):
+	descriptors=pickle.dumps([d for d,data in buffers],Pyro.config.PYRO_PICKLE_FORMAT)
+	sock_sendmsg(sock, struct.pack('!L',len(descriptors))+descriptors, timeout)
+	for descriptor,data in buffers:
+		sock_sendmsg(sock, data, timeout)
+
+def _recvOOB(sock, timeout):
+	size=struct.unpack('!L',sock_recvmsg(sock, 4, timeout))[0]
+	buffers=[]
+	for descriptor in pickle.loads(sock_recvmsg(sock, size, timeout)):
+		if descriptor[0]=='s':
+			buffers.append(sock_recvmsg(sock, descriptor[1], timeout))
+			continue
+		import numpy
+		array=numpy.empty(descriptor[2], numpy.dtype(descriptor[1]))
+		if hasattr(sock,'recv_into'):
+			sock_recvinto(sock, array.reshape(-1).view(numpy.uint8), array.nbytes, timeout)
+		else:
+			# SSL sockets can't receive into a buffer
+			data=sock_recvmsg(sock, array.nbytes, timeout)
+			array.reshape(-1).view(numpy.uint8)[:]=numpy.frombuffer(data, numpy.uint8)
+		buffers.append(array)
+	return buffers
+
+
+#------ Serializers: bits 4-6 of the pflags (PFLG_SERIALIZER) tell which one
+#------ encoded a message body, 0 being pickle. The client encodes its
+#------ requests with the serializer of its adapter, the server replies
+#------ with the serializer of the request. Any message the chosen
+#------ serializer can't encode exactly goes as pickle instead.
+
+PFLG_SERIALIZER = 0x70		# protocol flag bits: serializer identifier
+
+_serializers={'pickle': (0, None, None)}	# name: (pflags bits, dumps, loads)
+_serializerNames={0: 'pickle'}				# pflags bits: name
+
+def registerSerializer(name, ident, dumps, loads):
+	# ident 1-7 ends up in the pflags, dumps must raise for anything it
+	# can't encode without losing its type
+	if not 0<ident<8:
+		raise ValueError('serializer ident must be between 1 and 7')
+	_serializers[name]=(ident<<4, dumps, loads)
+	_serializerNames[ident<<4]=name
+
+def _dumps(obj, serializer):
+	# returns (body, out-of-band buffers, pflags)
+	if serializer!='pickle' and not Pyro.config.PYRO_XML_PICKLE:
+		bits,dumps,loads=_serializers[serializer]
+		try:
+			return dumps(obj), None, bits
+		except (TypeError, ValueError, OverflowError):
+			pass
+	body,buffers=_dumpsOOB(obj)
+	return body, buffers, 0
+
+def _loads(body, pflags):
+	bits=pflags&PFLG_SERIALIZER
+	if not bits:
+		return _loadsOOB(body)
+	try:
+		return _serializers[_serializerNames[bits]][2](body)
+	except KeyError:
+		raise ProtocolError('unknown serializer %d' % (bits>>4))
+
+_marshalScalars=frozenset([str, int, float, bool, unicode, long, complex, type(None)])
+
+def _plainData(obj):
+	# true if obj only holds builtin types that marshal keeps exactly,
+	# scalar items are checked inline as most messages are mostly scalars
+	t=type(obj)
+	if t in _marshalScalars:
+		return True
+	if t is tuple or t is list:
+		items=obj
+	elif t is dict:
+		items=itertools.chain(obj.iterkeys(), obj.itervalues())
+	else:
+		return False
+	for item in items:
+		if type(item) not in _marshalScalars and not _plainData(item):
+			return False
+	return True
+
+def _marshalDumps(obj):
+	# marshal silently turns subclasses and buffers into builtin types
+	if not _plainData(obj):
+		raise TypeError('marshal can only encode plain builtin types')
+	return marshal.dumps(obj, 2)
+
+registerSerializer('marshal', 1, _marshalDumps, marshal.loads)
+
+#------ Compact binary codec for None, bool, int, long, float, str, unicode,
+#------ tuple, list and dict. One tag byte per value, big endian numbers.
+#------ Decoding only ever builds those types, so it is safe for data
+#------ from untrusted peers (unlike pickle and marshal). It is written in
+#------ Python and several times slower than cPickle on small calls, so it
+#------ is a compactness and safety option, marshal is the low latency one.
+
+_packB=struct.Struct('!B').pack
+_packb=struct.Struct('!b').pack
+_packI=struct.Struct('!I').pack
+_packq=struct.Struct('!q').pack
+_packd=struct.Struct('!d').pack
+_unpackB=struct.Struct('!B').unpack_from
+_unpackb=struct.Struct('!b').unpack_from
+_unpackI=struct.Struct('!I').unpack_from
+_unpackq=struct.Struct('!q').unpack_from
+_unpackd=struct.Struct('!d').unpack_from
+
+def _binaryWrite(obj, write):
+	t=type(obj)
+	if t is str:
+		if len(obj)<256:
+			write('s'+_packB(len(obj)))
+		else:
+			write('S'+_packI(len(obj)))
+		write(obj)
+	elif t is int:
+		if -128<=obj<128:
+			write('b'+_packb(obj))
+		else:
+			write('i'+_packq(obj))
+	elif t is float:
+		write('d'+_packd(obj))
+	elif obj is None:
+		write('N')
+	elif t is bool:
+		write(obj and 'T' or 'F')
+	elif t is tuple or t is list:
+		write((t is tuple and 't' or 'l')+_packI(len(obj)))
+		for item in obj:
+			_binaryWrite(item, write)
+	elif t is dict:
+		write('D'+_packI(len(obj)))
+		for key,value in obj.iteritems():
+			_binaryWrite(key, write)
+			_binaryWrite(value, write)
+	elif t is unicode:
+		data=obj.encode('utf-8')
+		write('u'+_packI(len(data))+data)
+	elif t is long:
+		data=str(obj)
+		write('L'+_packI(len(data))+data)
+	else:
+		raise TypeError('binary serializer can not encode %s' % t)
+
+def _binaryRead(data, i):
+	# returns the value at data[i] and the index after it
+	tag=data[i]
+	i+=1
+	if tag=='s':
+		n=_unpackB(data, i)[0]
+		i+=1
+		return data[i:i+n], i+n
+	if tag=='b':
+		return _unpackb(data, i)[0], i+1
+	if tag=='i':
+		return _unpackq(data, i)[0], i+8
+	if tag=='d':
+		return _unpackd(data, i)[0], i+8
+	if tag=='N':
+		return None, i
+	if tag=='T':
+		return True, i
+	if tag=='F':
+		return False, i
+	if tag=='t' or tag=='l':
+		n=_unpackI(data, i)[0]
+		i+=4
+		items=[]
+		for k in xrange(n):
+			item,i=_binaryRead(data, i)
+			items.append(item)
+		if tag=='t':
+			return tuple(items), i
+		return items, i
+	if tag=='D':
+		n=_unpackI(data, i)[0]
+		i+=4
+		d={}
+		for k in xrange(n):
+			key,i=_binaryRead(data, i)
+			d[key],i=_binaryRead(data, i)
+		return d, i
+	n=_unpackI(data, i)[0]
+	i+=4
+	if i+n>len(data):
+		raise ValueError('truncated binary message')
+	if tag=='S':
+		return data[i:i+n], i+n
+	if tag=='u':
+		return data[i:i+n].decode('utf-8'), i+n
+	if tag=='L':
+		return long(data[i:i+n]), i+n
+	raise ValueError('invalid binary message tag %r' % tag)
+
+def _binaryDumps(obj):
+	out=[]
+	_binaryWrite(obj, out.append)
+	return ''.join(out)
+
+def _binaryLoads(data):
+	try:
+		obj,i=_binaryRead(data, 0)
+	except (IndexError, struct.error):
+		raise ProtocolError('truncated binary message')
+	if i!=len(data):
+		raise ProtocolError('invalid binary message length')
+	return obj
+
+registerSerializer('binary', 2, _binaryDumps, _binaryLoads)
+
+
+#------ Compression: PFLG_COMPRESSED marks a compressed body and the
+#------ PFLG_CODEC bits tell the codec, 0 being zlib. A CompressionPolicy
+#------ decides per message whether compressing is worth it: bodies below
+#------ the threshold are sent as they are, large bodies are first probed
+#------ by compressing a sample, and with a bandwidth given compression is
+#------ switched off while it costs more CPU time than the bytes it saves
+#------ would take on the wire. Every TCPConnection keeps its own stats.
+#------ The client announces its policy on the first request of each
+#------ connection and after every change, and the server compresses its
+#------ replies on that connection with it. Without an announcement the
+#------ server mirrors the codec of compressed requests.
+
+PFLG_CODEC =      0x0300	# protocol flag bits: compression codec
+PFLG_REQUESTID =  0x0400	# protocol flag: a !L request id follows the header
+PFLG_COMPRESSPARAMS = 0x0800	# protocol flag: the sender's compression policy follows (after the request id)
+
+# codec bits>>8 (255: no compression), level, threshold, probe, ratio,
+# bandwidth (0: none)
+_compressParamsFmt='!BBLLfd'
+_compressParamsSize=struct.calcsize(_compressParamsFmt)
+
+_codecs={}		# name: (pflags bits, compress(data,level), decompress(data))
+_codecNames={}	# pflags bits: name
+
+def _registerCodec(name, bits, compress, decompress):
+	_codecs[name]=(bits, compress, decompress)
+	_codecNames[bits]=name
+
+if _has_compression:
+	_registerCodec('zlib', 0x0000, zlib.compress, zlib.decompress)
+try:
+	import bz2
+	_registerCodec('bz2', 0x0100, bz2.compress, bz2.decompress)
+except ImportError:
+	pass
+try:
+	try:
+		import lzma
+	except ImportError:
+		from backports import lzma
+	_registerCodec('lzma', 0x0200, lambda data,level: lzma.compress(data,preset=level), lzma.decompress)
+except ImportError:
+	pass
+
+def newCompressionStats():
+	# messages: bodies seen, small: below the threshold, incompressible:
+	# rejected by the probe or not shrinking, unprofitable: skipped because
+	# of the bandwidth, rawbytes/saved: of the compressed bodies,
+	# cputime: seconds spent compressing and decompressing
+	return {'messages':0, 'compressed':0, 'small':0, 'incompressible':0,
+		'unprofitable':0, 'rawbytes':0, 'saved':0, 'cputime':0.0}
+
+class CompressionPolicy:
+	def __init__(self, codec='zlib', level=6, threshold=1024, probe=4096, ratio=0.9, bandwidth=None):
+		if codec not in _codecs:
+			raise ValueError('compression codec not available: '+str(codec))
+		self.codec=codec
+		self.level=level
+		self.threshold=threshold	# bytes, smaller bodies are not compressed
+		self.probe=probe			# bytes of the sample, 0 disables probing
+		self.ratio=ratio			# sample must shrink below this ratio
+		self.bandwidth=bandwidth	# link bytes/sec, None always compresses
+	def compress(self, body, stats):
+		# returns the body to send and the pflags to add
+		size=len(body)
+		stats['messages']+=1
+		if size<self.threshold:
+			stats['small']+=1
+			return body,0
+		if self.bandwidth and stats['compressed']>=8 and stats['messages']%32 \
+		   and stats['saved']<self.bandwidth*stats['cputime']:
+			# compressing costs more than sending, retry every 32 messages
+			stats['unprofitable']+=1
+			return body,0
+		bits,compress,decompress=_codecs[self.codec]
+		start=time.time()
+		try:
+			if self.probe and size>2*self.probe:
+				sample=body[(size-self.probe)//2:(size+self.probe)//2]
+				if len(compress(sample,self.level))>self.ratio*len(sample):
+					stats['incompressible']+=1
+					return body,0
+			packed=compress(body,self.level)
+		finally:
+			stats['cputime']+=time.time()-start
+		if len(packed)>=size:
+			stats['incompressible']+=1
+			return body,0
+		stats['compressed']+=1
+		stats['rawbytes']+=size
+		stats['saved']+=size-len(packed)
+		return packed, PFLG_COMPRESSED|bits
+	def __repr__(self):
+		return '<CompressionPolicy %s level %s threshold %s>' % (self.codec,self.level,self.threshold)
+
+def _packCompressionPolicy(policy):
+	if policy is None:
+		return struct.pack(_compressParamsFmt, 255, 0, 0, 0, 0, 0)
+	return struct.pack(_compressParamsFmt, _codecs[policy.codec][0]>>8,
+		policy.level, policy.threshold, policy.probe, policy.ratio,
+		policy.bandwidth or 0)
+
+def _unpackCompressionPolicy(data):
+	codec,level,threshold,probe,ratio,bandwidth=struct.unpack(_compressParamsFmt, data)
+	if codec==255:
+		return None
+	codec=_codecNames.get(codec<<8)
+	if codec is None:
+		raise ProtocolError('compression not supported')
+	return CompressionPolicy(codec, level, threshold, probe, ratio, bandwidth or None)
+
+def _configCompressionPolicy(codec=None):
+	# policy from the PYRO_COMPRESSION_* configuration items
+	return CompressionPolicy(codec or Pyro.config.PYRO_COMPRESSION_CODEC,
+		Pyro.config.PYRO_COMPRESSION_LEVEL, Pyro.config.PYRO_COMPRESSION_THRESHOLD,
+		Pyro.config.PYRO_COMPRESSION_PROBE)
+
+_replyPolicies={}	# codec name: policy used to mirror the client's codec
 
 
 class PYROAdapter:
@@ -201,6 +657,11 @@ class PYROAdapter:
 		self.onewayMethods=[]		# methods that should be called one-way
 		self.timeout=None			# socket timeout
 		self.ident=''				# connection identification
+		self.serializer=Pyro.config.PYRO_SERIALIZER	# for requests
+		self.compression=None		# CompressionPolicy
+		if _has_compression and Pyro.config.PYRO_COMPRESSION:
+			self.compression=_configCompressionPolicy()
+		self.announceCompression=0	# send the policy with the next request
 		self.setNewConnectionValidator(DefaultConnValidator())
 		self.__getLockObjects()
 	def sendAccept(self, conn):		# called by TCPServer
@@ -259,6 +720,8 @@ class PYROAdapter:
 				if msg==self.acceptMSG:
 					self.conn=conn
 					self.conn.connected=1
+					# the server answers with our policy (setCompression)
+					self.announceCompression=self.compression is not None
 					Log.msg('PYROAdapter','connected to',str(URI))
 					if URI.protocol=='PYROLOC':
 						self.resolvePYROLOC_URI("PYRO") # updates self.URI
@@ -314,24 +777,58 @@ class PYROAdapter:
 					time.sleep(wait)
 		raise TimeoutError('connection lost')
 		
-	def createMsg(self, body, replyflags=0):
+	def createMsg(self, body, replyflags=0, conn=None, requestID=None):
 		pflgs=replyflags
-		if _has_compression and Pyro.config.PYRO_COMPRESSION:
-			before=len(body)
-			bz=zlib.compress(body) # default compression level
-			if len(bz)<before:
-				pflgs|=PFLG_COMPRESSED
-				body=bz
+		policy=self.compression
+		if conn is not None and conn.replyCompression is not None:
+			policy=conn.replyCompression
+		params=''
+		if self.announceCompression:
+			self.announceCompression=0
+			params=_packCompressionPolicy(self.compression)
+			pflgs|=PFLG_COMPRESSPARAMS
+		if policy is not None:
+			if conn is not None:
+				stats=conn.compressionStats
+			else:
+				stats=newCompressionStats()
+			body,flags=policy.compress(body,stats)
+			pflgs|=flags
 		crc=0
 		if Pyro.config.PYRO_CHECKSUM and _has_compression:
 			crc=zlib.adler32(body)
 			pflgs|=PFLG_CHECKSUM
 		if Pyro.config.PYRO_XML_PICKLE=='gnosis':
 			pflgs|=PFLG_XMLPICKLE_GNOSIS
-		return struct.pack(self.headerFmt, self.headerID, self.version, self.headerSize, len(body), pflgs, crc) + body
+		if requestID is not None:
+			# the id goes between the header and the body, the reply echoes it
+			pflgs|=PFLG_REQUESTID
+			return struct.pack(self.headerFmt, self.headerID, self.version, self.headerSize, len(body), pflgs, crc) + struct.pack('!L',requestID) + params + body
+		return struct.pack(self.headerFmt, self.headerID, self.version, self.headerSize, len(body), pflgs, crc) + params + body
+
+	def sendMsg(self, conn, body, buffers=None, replyflags=0, requestID=None):
+		# send a message body followed by its out-of-band buffers, if any
+		if not buffers:
+			sock_sendmsg(conn.sock, self.createMsg(body,replyflags,conn,requestID), self.timeout)
+		else:
+			sock_sendmsg(conn.sock, self.createMsg(body,replyflags|PFLG_OOB,conn,requestID), self.timeout)
+			_sendOOB(conn.sock, buffers, self.timeout)
 
 	def setOneway(self, methods):
 		self.onewayMethods.extend(methods)
+	def setSerializer(self, name):
+		if name not in _serializers:
+			raise ValueError('unknown serializer: '+str(name))
+		self.serializer=name
+	def setCompression(self, policy):
+		# CompressionPolicy for the requests and, once announced to the
+		# server, for its replies, None disables compression
+		self.compression=policy
+		self.announceCompression=1
+	def getCompressionStats(self):
+		if 'conn' not in self.__dict__:
+			return newCompressionStats()
+		return self.conn.compressionStats.copy()
 	def setTimeout(self, timeout):
 		if os.name=='java':
 			# don't allow the use of the timeout feature in jython because it causes unreliable behavior
@@ -430,6 +927,59 @@ class PYROAdapter:
 		finally:
 			self.lock.release()
 
+	def pipelineInvocation(self, calls):
+		try:
+			self.lock.acquire() # the connection is ours until every reply is in
+			return self._pipelineInvocation(calls)
+		finally:
+			self.lock.release()
+
+	def _pipelineInvocation(self, calls):
+		# Sends the (method, flags, args) calls back to back, each with its
+		# request id, from a writer thread while this thread reads the replies
+		# and matches them by id. The server runs them in order. Returns the
+		# answers in call order, failed calls as their PyroExceptionCapsule.
+		# Oneway calls and mobile code are not supported here.
+		if 'conn' not in self.__dict__.keys():
+			if 'URI' in self.__dict__.keys():
+				self.bindToURI(self.URI)
+			else:
+				raise ProtocolError('trying to rebind, but was never bound before')
+		conn=self.conn
+		messages=[]
+		for method,flags,args in calls:
+			messages.append(_dumps((self.URI.objectID,method,flags&~Pyro.constants.RIF_Oneway,args),self.serializer))
+		failure=[]
+		def writer():
+			try:
+				for requestID,(body,buffers,serflags) in enumerate(messages):
+					self.sendMsg(conn,body,buffers,serflags,requestID)
+			except Exception,x:
+				failure.append(x)
+		thread=Thread(target=writer)
+		thread.setDaemon(1)
+		thread.start()
+		missing=object()
+		answers=[missing]*len(messages)
+		pending=len(messages)
+		try:
+			while pending:
+				ver,answer,pflags = self.receiveMsg(conn,1)
+				requestID=conn.requestID
+				if answer is None or requestID is None or requestID>=len(answers) or answers[requestID] is not missing:
+					raise ProtocolError('incorrect answer received')
+				answers[requestID]=_loads(answer,pflags)
+				pending-=1
+		except:
+			# the connection is out of sync now, dropping it also unblocks the writer
+			self.release(nolog=1)
+			thread.join()
+			raise
+		thread.join()
+		if failure:
+			raise failure[0]
+		return answers
+
 	def _remoteInvocation(self, method, flags, *args):
 		if 'conn' not in self.__dict__.keys():
 			Log.msg('PYROAdapter','no connection, trying to bind again')
@@ -439,8 +989,8 @@ class PYROAdapter:
 				raise ProtocolError('trying to rebind, but was never bound before')
 		if method in self.onewayMethods:
 			flags |= Pyro.constants.RIF_Oneway
-		body=pickle.dumps((self.URI.objectID,method,flags,args),Pyro.config.PYRO_PICKLE_FORMAT)
-		sock_sendmsg(self.conn.sock, self.createMsg(body), self.timeout)
+		body,buffers,serflags=_dumps((self.URI.objectID,method,flags,args),self.serializer)
+		self.sendMsg(self.conn, body, buffers, serflags)
 		if flags & Pyro.constants.RIF_Oneway:
 			return None		# no answer required, return immediately
 		ver,answer,pflags = self.receiveMsg(self.conn,1)  # read the server's response, send no further replies
@@ -451,7 +1001,7 @@ class PYROAdapter:
 		# If there are import problems, try to get those modules from
 		# the server too (if mobile code is enabled).
 		if not Pyro.config.PYRO_MOBILE_CODE:
-			answer = pickle.loads(answer)
+			answer = _loads(answer,pflags)
 		else:
 			importer=None
 			try:
@@ -467,7 +1017,7 @@ class PYROAdapter:
 					imp.release_lock()
  
 					try:
-						answer = pickle.loads(answer)
+						answer = _loads(answer,pflags)
 						loaded = 1
 					except ImportError:
 						mname = importer.name
@@ -531,6 +1081,7 @@ class PYROAdapter:
 
 	# (private) receives a socket message, returns: (protocolver, message, protocolflags)
 	def receiveMsg(self,conn,noReply=0):
+		conn.requestID=None
 		msg=sock_recvmsg(conn.sock, self.headerSize, self.timeout)
 		(hid, ver, hsiz, bsiz, pflags, crc) = struct.unpack(self.headerFmt,msg)
 		# store in the connection what pickle method this is
@@ -551,6 +1102,12 @@ class PYROAdapter:
 				# try to report error to client, but most likely the connection will terminate:
 				self.returnException(conn, ProtocolError(msg), shutdown=1)
 			raise ProtocolError(msg)
+		if pflags&PFLG_REQUESTID:
+			conn.requestID=struct.unpack('!L',sock_recvmsg(conn.sock, 4, self.timeout))[0]
+		if pflags&PFLG_COMPRESSPARAMS:
+			# the peer's policy, used for the replies on this connection
+			conn.replyCompression=_unpackCompressionPolicy(sock_recvmsg(conn.sock, _compressParamsSize, self.timeout))
+			conn.compressionAnnounced=1
 		body=sock_recvmsg(conn.sock, bsiz, self.timeout)
 		if pflags&PFLG_CHECKSUM:
 			if _has_compression:
@@ -563,12 +1120,23 @@ class PYROAdapter:
 			else:
 				raise ProtocolError('cannot perform checksum')
 		if pflags&PFLG_COMPRESSED:
-			if _has_compression:
-				body=zlib.decompress(body)
+			codec=_codecNames.get(pflags&PFLG_CODEC)
+			if codec is not None:
+				start=time.time()
+				body=_codecs[codec][2](body)
+				conn.compressionStats['cputime']+=time.time()-start
+				if not noReply and not conn.compressionAnnounced:
+					# answer with the codec the client chose
+					if codec not in _replyPolicies:
+						_replyPolicies[codec]=_configCompressionPolicy(codec)
+					conn.replyCompression=_replyPolicies[codec]
 			else:
 				# We received a compressed message but cannot decompress.
 				# Is this really a server error? We now throw an exception on the server...
 				raise ProtocolError('compression not supported')
+		if pflags&PFLG_OOB:
+			body=_OOBBody(body)
+			body.oobBuffers=_recvOOB(conn.sock, self.timeout)
 		return ver,body,pflags
 
 	def _unpickleRequest(self, pflags, body):
@@ -581,7 +1149,7 @@ class PYROAdapter:
 			Log.error('PYROAdapter','xml pickle required, got other pickle')
 			raise ProtocolError('xml pickle required, got other pickle')
 		else:
-			return pickle.loads(body)
+			return _loads(body,pflags)
 
 	def handleInvocation(self,daemon,conn):
 		ver,body,pflags = self.receiveMsg(conn)
@@ -673,10 +1241,11 @@ class PYROAdapter:
 					body=pickle.dumps(res,Pyro.config.PYRO_PICKLE_FORMAT)
 				else:
 					body=Pyro.util.getXMLPickle('gnosis').dumps(res,Pyro.config.PYRO_PICKLE_FORMAT)
+				buffers=None
 			else:
-				replyflags=0
-				body=pickle.dumps(res,Pyro.config.PYRO_PICKLE_FORMAT)
-			sock_sendmsg(conn.sock, self.createMsg(body,replyflags),self.timeout)
+				serializer=_serializerNames.get(pflags&PFLG_SERIALIZER,'pickle')
+				body,buffers,replyflags=_dumps(res,serializer)
+			self.sendMsg(conn, body, buffers, replyflags, conn.requestID)
 		except ImportError,ix:
 			if Pyro.config.PYRO_MOBILE_CODE:
 				# Return a special exception that will be processed by client;
@@ -712,7 +1281,7 @@ class PYROAdapter:
 		except Exception,x:
 			# hmm, pickling the exception failed... pickle the string instead
 			body=pic.dumps(PyroExceptionCapsule(PyroError(str(x)),args),Pyro.config.PYRO_PICKLE_FORMAT)
-		sock_sendmsg(conn.sock, self.createMsg(body),self.timeout)
+		sock_sendmsg(conn.sock, self.createMsg(body,0,conn,conn.requestID),self.timeout)
 		if shutdown:
 			conn.close()
 
@@ -830,6 +1399,10 @@ class TCPConnection:
 		self.addr = addr
 		self.connected=0		# connected?	
 		self.pflags=0			# protocol flags
+		self.requestID=None		# id of the last message received, if any
+		self.replyCompression=None	# CompressionPolicy mirroring the peer
+		self.compressionAnnounced=0	# replyCompression was sent by the peer
+		self.compressionStats=newCompressionStats()
 	def __del__(self):
 		self.close()
 	def fileno(self):
@@ -921,6 +1494,7 @@ class LocalStorage:
 
 
 class TCPServer:
+	eventLoop=None		# EventLoop of the eventloop server mode
 	def __init__(self, port, host='', threaded=_has_threading,prtcol='PYRO'):
 		self._ssl_server = 0
 		self.connections = []  # connection threads
@@ -975,6 +1549,9 @@ class TCPServer:
 		
 	def closedown(self, nolog=0):
 		# explicit closedown request
+		if self.eventLoop is not None:
+			self.eventLoop.close()
+			self.eventLoop=None
 		if len(self.connections)>0:
 			if not nolog:
 				Log.warn('TCPServer','Shutting down but there are still',len(self.connections),'active connections')
@@ -1023,7 +1600,7 @@ class TCPServer:
 			self._removeFromConnectionList(None)
 
 	def _removeFromConnectionList(self, obj):
-		if self.threaded and currentThread:
+		if self.threaded and currentThread and self.eventLoop is None:
 			obj=currentThread()
 		try:
 			self.connections.remove(obj)
@@ -1039,7 +1616,11 @@ class TCPServer:
 	def handleRequests(self, timeout=None, others=[], callback=None):
 		if others and not callback:
 			raise ProtocolError('callback required')
-		if self.threaded:
+		if self.threaded and Pyro.config.PYRO_SERVER_MODE=='eventloop':
+			if self.eventLoop is None:
+				self.eventLoop=EventLoop(self, Pyro.config.PYRO_SERVER_WORKERS)
+			self.eventLoop.poll(timeout,others,callback)
+		elif self.threaded:
 			self._handleRequest_Threaded(timeout,others,callback)
 		else:
 			self._handleRequest_NoThreads(timeout,others,callback)
@@ -1090,6 +1671,18 @@ class TCPServer:
 	# def handleInvocation(self, conn):	.... abstract method (implemented in subclass)
 
 
+	def _accept(self):
+		# returns a TCPConnection for a new incoming connection, None on SSL errors
+		if self._ssl_server:
+			try:
+				csock, addr = self.sock.accept()
+			except SSL.SSLError,error:
+				Log.warn('TCPServer','SSL error: '+str(error))
+				return None
+		else:
+			csock, addr = self.sock.accept()
+		return TCPConnection(csock,addr)
+
 	def _handleRequest_Threaded(self,timeout,others,callback):
 		# self.connections is used to keep track of connection Threads
 		socklist = [self.sock]+others
@@ -1146,6 +1739,199 @@ class TCPServer:
 		else:
 			return map(lambda conn: conn.sock, self.connections)+[self.sock]
 
+#------ Event loop server mode (PYRO_SERVER_MODE='eventloop'): instead of a
+#------ thread per connection, the thread running the request loop waits on
+#------ the server socket and every idle connection at once, using epoll,
+#------ poll or select (whichever the platform has). A readable connection is
+#------ taken out of the poller and handed to one of PYRO_SERVER_WORKERS
+#------ worker threads, which reads, runs and answers that request. The
+#------ worker then gives the connection back and wakes the loop up through
+#------ a socket pair. Requests of one connection still run one after another.
+
+class _EpollPoller:
+	def __init__(self):
+		self.epoll=select.epoll()
+	def register(self, fd):
+		self.epoll.register(fd, select.EPOLLIN|select.EPOLLPRI|select.EPOLLERR|select.EPOLLHUP)
+	def unregister(self, fd):
+		self.epoll.unregister(fd)
+	def poll(self, timeout):
+		if timeout is None:
+			timeout=-1
+		return [fd for fd,event in self.epoll.poll(timeout)]
+	def close(self):
+		self.epoll.close()
+
+class _PollPoller:
+	def __init__(self):
+		self.pollobj=select.poll()
+	def register(self, fd):
+		self.pollobj.register(fd, select.POLLIN|select.POLLPRI|select.POLLERR|select.POLLHUP)
+	def unregister(self, fd):
+		self.pollobj.unregister(fd)
+	def poll(self, timeout):
+		if timeout is not None:
+			timeout=int(timeout*1000)
+		return [fd for fd,event in self.pollobj.poll(timeout)]
+	def close(self):
+		pass
+
+class _SelectPoller:
+	def __init__(self):
+		self.fds=set()
+	def register(self, fd):
+		self.fds.add(fd)
+	def unregister(self, fd):
+		self.fds.discard(fd)
+	def poll(self, timeout):
+		return safe_select(list(self.fds),[],[],timeout)[0]
+	def close(self):
+		pass
+
+def _wakeupPair():
+	# connected pair of sockets, select() on Windows only takes sockets
+	if hasattr(socket,'socketpair'):
+		return socket.socketpair()
+	listener=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	listener.bind(('127.0.0.1',0))
+	listener.listen(1)
+	waker=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	waker.connect(listener.getsockname())
+	wakeup,addr=listener.accept()
+	listener.close()
+	return wakeup,waker
+
+def _newPoller():
+	if hasattr(select,'epoll'):
+		return _EpollPoller()
+	if hasattr(select,'poll'):
+		return _PollPoller()
+	return _SelectPoller()
+
+class EventLoop:
+	def __init__(self, server, workers):
+		import Queue
+		self.server=server
+		self.poller=_newPoller()
+		self.jobs=Queue.Queue()			# (function, connection) for the workers
+		self.returned=Queue.Queue()		# connections to watch again
+		self.conns={}					# fd: idle connection
+		self.wakeup,self.waker=_wakeupPair()
+		self.wakeup.setblocking(0)
+		self.waker.setblocking(0)
+		self.poller.register(server.sock.fileno())
+		self.poller.register(self.wakeup.fileno())
+		self.workers=[]
+		for i in range(max(1,workers)):
+			thread=Thread(target=self._work)
+			thread.setDaemon(1)
+			thread.localStorage=LocalStorage()
+			server.initTLS(thread.localStorage)
+			self.workers.append(thread)
+			thread.start()
+		Log.msg('EventLoop','started with',len(self.workers),'workers, using',self.poller.__class__.__name__)
+
+	def poll(self, timeout, others, callback):
+		self._watchReturned()
+		others=dict([(o.fileno(),o) for o in others])
+		for fd in others:
+			self.poller.register(fd)
+		try:
+			try:
+				fds=self.poller.poll(timeout)
+			except (select.error, IOError, OSError),x:
+				if x.args[0] == errno.EINTR or (hasattr(errno, 'WSAEINTR') and x.args[0] == errno.WSAEINTR):
+					return
+				raise
+		finally:
+			for fd in others:
+				self.poller.unregister(fd)
+		fired=[]
+		for fd in fds:
+			if fd==self.server.sock.fileno():
+				conn=self.server._accept()
+				if conn is not None:
+					self.jobs.put((self._handshake,conn))
+			elif fd==self.wakeup.fileno():
+				try:
+					while self.wakeup.recv(4096):
+						pass
+				except socket.error:
+					pass
+				self._watchReturned()
+			elif fd in self.conns:
+				self.poller.unregister(fd)
+				self.jobs.put((self._invoke,self.conns.pop(fd)))
+			elif fd in others:
+				fired.append(others[fd])
+		if fired and callback:
+			callback(fired)
+
+	def _watchReturned(self):
+		import Queue
+		while 1:
+			try:
+				conn=self.returned.get_nowait()
+			except Queue.Empty:
+				return
+			if conn.connected:
+				fd=conn.fileno()
+				self.conns[fd]=conn
+				self.poller.register(fd)
+
+	def _giveBack(self, conn):
+		self.returned.put(conn)
+		try:
+			self.waker.send('x')
+		except socket.error:
+			pass	# buffer full, the loop will wake up anyway
+
+	def _work(self):
+		while 1:
+			job=self.jobs.get()
+			if job is None:
+				return
+			function,conn=job
+			try:
+				function(conn)
+			except Exception,x:
+				Log.error('EventLoop','unexpected error handling',conn,x)
+				self.server.removeConnection(conn)
+
+	def _handshake(self, conn):
+		if self.server.getAdapter().handleConnection(conn, self.server):
+			self.server.connections.append(conn)
+			Log.msg('TCPServer','new connection ',conn, ' #conns=',len(self.server.connections))
+			self._giveBack(conn)
+		else:
+			# log entry has already been written by newConnValidator
+			self.server.removeConnection(conn)
+
+	def _invoke(self, conn):
+		try:
+			self.server.handleInvocation(conn)
+		except ConnectionClosedError:
+			# client went away.
+			self.server.removeConnection(conn)
+			return
+		except (PyroExceptionCapsule, Exception):
+			self.server.handleError(conn)
+		if conn.connected:
+			self._giveBack(conn)
+		else:
+			self.server.removeConnection(conn)
+
+	def close(self):
+		for thread in self.workers:
+			self.jobs.put(None)
+		for conn in self.conns.values():
+			conn.close()
+		self.conns={}
+		self.poller.close()
+		self.wakeup.close()
+		self.waker.close()
+
+
 # Sometimes safe_select() raises an select.error exception with the EINTR
 # errno flag set, which basically tells the caller to try again later.
 # This safe_select method works around this case and indeed just tries again.
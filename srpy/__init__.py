@@ -79,6 +79,9 @@ remote python engines.
 import sys, os
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 from srpyclient import *
-from srpyapp import newSubEngine, detectNCPUs
+from srpyfuture import Future, WorkerPool
+from srpyasync import AsyncPythonEngine, AsyncEngBox
+from srpyapp import newSubEngine, newSubEngines, newEngBox, ForkServer, detectNCPUs
+from srpysupervisor import Supervisor, EngineHealth
 from srpyinfo import version, copyright
 
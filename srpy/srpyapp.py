@@ -45,13 +45,20 @@ def shell():
     print "SRPy Server - Simple Remote Python, Network Server"
     print "http://code.google.com/p/srpy/ - updates, documentation, examples and support"
 
-    parser = OptionParser(version="%prog "+srpyinfo.version, usage="\n  %prog --basic [optional arguments]\n  %prog --multi [optional arguments]")
+    parser = OptionParser(version="%prog "+srpyinfo.version, usage="\n  %prog --basic [optional arguments]\n  %prog --pool [optional arguments]\n  %prog --multi [optional arguments]\n  %prog --forkserver [--preload modules] [optional arguments]")
     parser.add_option("-b", "--basic", action="store_true", dest="basic", help="starts a single python engine, stdout is visible, debug mode can only be used with this option", default=False)
     parser.add_option("-m", "--multi", action="store_true", dest="multi", help="starts pyengine in multi-core mode, stdout is invisible, able to spawn servers in each available cpu, ncpus can be used with this option", default=False)
+    parser.add_option("-f", "--forkserver", action="store_true", dest="forkserver", help="starts a template process that forks new python engines on demand (see srpyapp.ForkServer), unix only", default=False)
+    parser.add_option("--preload", action="store", dest="preload", help="used with --forkserver, comma separated list of modules the template imports once so every forked engine starts with them loaded", default="")
+    parser.add_option("-s", "--supervise", action="store_true", dest="supervise", help="used with --multi, pings the python engines every few seconds and restarts the ones that crash, the uri file is rewritten after each restart", default=False)
+    parser.add_option("-P", "--pool", action="store_true", dest="pool", help="used with --basic, the python engine runs 'vexe' and 'apply' calls on a pool of worker processes, one per cpu unless --ncpus is given", default=False)
     parser.add_option("-n", "--ncpus", type='int', dest="ncpus", help="how many Python Engines should be started, by default starts one engine per cpu (Eg: dual-core computer will start 2 instances by default)", default=0)
     parser.add_option("-u", "--uri", action="store", dest="urifile", help="filename where to save Python Engines uri information")
     parser.add_option("-p", "--pyrocfg", action="store", dest="pyro_configfile", help="Pyro configuration file, check http://pyro.sourceforge.net/manual/3-install.html for options")
     parser.add_option("-d", "--debug", action="store_true", dest="debug", help="prints extra information about data transfer and execution on the Python engine, can only be used in 'basic' mode", default=False)
+    parser.add_option("-l", "--locktimeout", type='float', dest="locktimeout", help="seconds a remote call waits for the python engine lock before failing, by default 30, 0 or less waits forever", default=30)
+    parser.add_option("-e", "--eventloop", action="store_true", dest="eventloop", help="serves all the connections from one I/O thread and a pool of worker threads instead of one thread per connection, for engines with many clients (see also PYRO_MAXCONNECTIONS)", default=False)
+    parser.add_option("-w", "--workers", type='int', dest="workers", help="number of worker threads in --eventloop mode, by default 16", default=0)
     parser.add_option("-t", "--time", action="store_true", dest="time", help="prints how mutch time each remote call took to execute", default=False)
     
     (options, args) = parser.parse_args()
@@ -61,12 +68,22 @@ def shell():
         #parser.error("please select either option --basic or --multi")
     if options.basic and options.multi:
         parser.error("options --basic and --multi are mutually exclusive")
-    if options.basic and options.ncpus:
-        parser.error("options --ncpus can only be used in muti-core mode (--multi)")
+    if options.forkserver and (options.multi or options.pool):
+        parser.error("option --forkserver can't be used with --multi or --pool")
+    if options.preload and not options.forkserver:
+        parser.error("option --preload can only be used with --forkserver")
+    if options.multi and options.pool:
+        parser.error("options --pool can only be used in basic mode (--basic)")
+    if options.basic and options.ncpus and not options.pool:
+        parser.error("options --ncpus can only be used in muti-core mode (--multi) or with --pool")
     if options.multi and options.debug:
         parser.error("options --debug can only be used in basic mode (--basic)")
     if options.multi and options.time:
         parser.error("options --time can only be used in basic mode (--basic)")
+    if options.supervise and not options.multi:
+        parser.error("options --supervise can only be used in muti-core mode (--multi)")
+    if options.workers and not options.eventloop:
+        parser.error("options --workers can only be used with --eventloop")
     
     # Load Pyro Configuration
     if options.pyro_configfile!=None:
@@ -78,6 +95,20 @@ def shell():
         else:
             print "WARNING, could not find Pyro configuration file: "+path
     
+    # Select the server mode, sub engines inherit it from the environment
+    if options.eventloop:
+        os.environ['PYRO_SERVER_MODE']='eventloop'
+        if options.workers:
+            os.environ['PYRO_SERVER_WORKERS']=str(options.workers)
+    
+    ##### Start Fork Server Mode #####
+    if options.forkserver:
+        locktimeout=options.locktimeout
+        if locktimeout<=0: locktimeout=None
+        preload=[name for name in options.preload.split(',') if name]
+        forkServer(preload, debug=options.debug, lockTimeout=locktimeout)
+        return
+    
     # Create a location for the uri files    
     if options.urifile==None:
         tempdir=tempfile.mkdtemp('PyEngineURI')
@@ -94,7 +125,16 @@ def shell():
         print "Starting Basic Server..."
         tempdir=tempfile.mkdtemp('PyEngineURI')
         urifile=os.path.join(tempdir, 'uri.txt')
-        PES=srpyserver.PythonEngineServer(urifile=urifile, debug=options.debug)
+        locktimeout=options.locktimeout
+        if locktimeout<=0: locktimeout=None
+        processes=0
+        if options.pool:
+            processes=options.ncpus
+            if processes==0: processes=detectNCPUs()
+            print "Starting %d worker processes..." % processes
+        PES=srpyserver.PythonEngineServer(urifile=urifile, debug=options.debug,
+                                          lockTimeout=locktimeout,
+                                          processes=processes)
         PES.start(threaded=True)
         uriinfo=open(urifile).read()
     ##### Start Multi-Core Mode #####
@@ -104,12 +144,25 @@ def shell():
         ncpus=options.ncpus
         if ncpus==0: ncpus=detectNCPUs()
         # Prepare to initialize
-        procs=[]
-        uriinfo=""
-        for n in range(ncpus):
-            uriinfo_, proc = newSubEngine()
-            procs.append(proc)
-            uriinfo=uriinfo+uriinfo_
+        start=time.time()
+        engines=newSubEngines(ncpus)
+        procs=[proc for uriinfo_, proc in engines]
+        uriinfo="".join([uriinfo_ for uriinfo_, proc in engines])
+        print "Started %d engines in %.2fs" % (uriinfo.count("PYRO"),
+                                              time.time()-start)
+        if options.supervise:
+            try: import srpyclient, srpysupervisor
+            except ImportError: from srpy import srpyclient, srpysupervisor
+            engbox=srpyclient.EngBox([srpyclient.PythonEngine(uri.strip())
+                                      for uri, proc in engines])
+            for pyeng, (uri, proc) in zip(engbox, engines): pyeng.proc=proc
+            def respawned(old, new):
+                print "Restarted engine %s as %s" % (old.uri, new.uri)
+                if options.urifile!=None:
+                    open(options.urifile, 'w').write(
+                        "".join([pyeng.uri+"\n" for pyeng in engbox]))
+            supervisor=srpysupervisor.Supervisor(engbox, onRespawn=respawned)
+            supervisor.start()
 
     print "URI info:"
     print uriinfo
@@ -131,28 +184,306 @@ def newSubEngine(timeout=30):
     @return: uri id, pipe to the new subprocess
     @rtype: str, subprocess
     """
-    tempdir=tempfile.mkdtemp('PyEngineURI')
-    urifile=os.path.join(tempdir, 'uri.txt')
+    return newSubEngines(1, timeout)[0]
+
+def newSubEngines(n, timeout=30):
+    """
+    Starts n srpyapp subprocesses with the 'basic' option at once. Each
+    engine prints its uri as soon as its daemon is bound, and the uri is read
+    from the subprocess output pipe, so the engines start in parallel and
+    the call returns as soon as the slowest one is ready.
+    
+    Example:
     
+    >>> import srpy
+    >>> engines = srpy.newSubEngines(4)
+    >>> uris = [uri for uri, proc in engines]
+    
+    @param n: number of engines to start
+    @type n: int
+    @param timeout: maximum amount of time to wait for servers to start.
+    @type timeout: int
+    @return: (uri id, pipe to the subprocess) for each engine
+    @rtype: list
+    """
+    import threading
     command = "\"" + sys.executable + "\" -u \"" \
               + os.path.dirname(os.path.abspath(__file__))\
-              + os.sep + "srpyapp.py\" -b -u %s" % repr(urifile).replace("'", '"')
+              + os.sep + "srpyapp.py\" -b"
     if sys.platform.startswith("win"):
         # workargound for windows
         command = "\"" + command + "\""
     else:
-        # do not show "Borken pipe message" at exit on unix/linux
-        command += " 2>/dev/null"     
-    proc=subprocess.Popen(command, stdin=subprocess.PIPE,
-                          stdout=subprocess.PIPE,
-                          stderr=subprocess.PIPE, shell=True)
+        # do not show "Borken pipe message" at exit on unix/linux, exec so
+        # the subprocess is the engine itself and not a shell around it
+        command = "exec " + command + " 2>/dev/null"
+    procs=[subprocess.Popen(command, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, shell=True)
+           for i in range(n)]
+    uris=[""]*n
+    def readURI(index):
+        # the first line starting with the protocol name is the uri
+        for line in iter(procs[index].stdout.readline, ''):
+            if line.startswith("PYRO"):
+                uris[index]=line
+                return
+    readers=[threading.Thread(target=readURI, args=(i,)) for i in range(n)]
+    for reader in readers:
+        reader.setDaemon(True)
+        reader.start()
+    deadline=time.time()+timeout
+    for reader in readers: reader.join(max(0, deadline-time.time()))
+    return zip(uris, procs)
+
+def newEngBox(n=0, timeout=30, **kwds):
+    """
+    Starts n engines as subprocesses in parallel (see L{newSubEngines}) and
+    returns an EngBox connected to all of them. Each PythonEngine keeps its
+    subprocess in its 'proc' attribute, the EngBox keeps every subprocess in
+    'procs' and the seconds it took to start and connect every engine in
+    'startupTime'.
+    
+    Example:
+    
+    >>> import srpy
+    >>> engbox = srpy.newEngBox(4)
+    >>> len(engbox), engbox.startupTime < 5
+    (4, True)
+    
+    @param n: number of engines to start, by default one per cpu
+    @type n: int
+    @param timeout: maximum amount of time to wait for servers to start.
+    @type timeout: int
+    @param kwds: extra arguments for each L{PythonEngine <srpyclient.PythonEngine>}
+    @rtype: L{EngBox <srpyclient.EngBox>}
+    """
+    try: import srpyclient
+    except ImportError: from srpy import srpyclient
+    from srpyerror import SRPyServerNotFound
     start=time.time()
-    while (time.time()-start)<timeout:    
-        if os.path.exists(urifile):
-            uriinfo=open(urifile).read()
-            if uriinfo.count("PYRO")>0: break
-        time.sleep(0.01)
-    return uriinfo, proc
+    if n==0: n=detectNCPUs()
+    engines=newSubEngines(n, timeout)
+    for uri, proc in engines:
+        if not uri: raise SRPyServerNotFound, "engine did not start in %ss" % timeout
+    engbox=srpyclient.EngBox([srpyclient.PythonEngine(uri.strip(), **kwds)
+                              for uri, proc in engines])
+    for pyeng, (uri, proc) in zip(engbox, engines): pyeng.proc=proc
+    engbox.procs=[proc for uri, proc in engines]
+    engbox.startupTime=time.time()-start
+    return engbox
+
+def forkServer(preload=[], path=None, **kwds):
+    """
+    Runs a fork server, used by 'srpyapp.py --forkserver'. The modules in
+    preload are imported once, then every connection to the unix socket at
+    path that sends 'fork' gets a new python engine forked from this
+    process, which shares its memory copy-on-write and replies with the
+    engine uri and pid. Forked engines exit with the fork server, which
+    stops when 'quit' or 'exit' is read from stdin or stdin is closed.
+    
+    @param preload: names of the modules to import before forking
+    @type preload: list of strs
+    @param path: unix socket path, by default a new temporary file
+    @type path: str
+    @param kwds: extra arguments for each
+    L{PythonEngine <srpyserver.PythonEngine>}
+    @rtype: None
+    """
+    import socket, select, signal, random
+    try: import srpyserver
+    except ImportError: from srpy import srpyserver
+    import Pyro.core
+    if not hasattr(os, 'fork'):
+        raise OSError("the fork server needs os.fork")
+    Pyro.core.initServer()
+    for name in preload:
+        try: __import__(name)
+        except ImportError, error:
+            print "WARNING, could not preload %s: %s" % (name, error)
+    if path is None: path=os.path.join(tempfile.mkdtemp('PyEngineFork'),
+                                       'fork.sock')
+    listener=socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(128)
+    children=[]
+    def reap():
+        # a pid stays ours until it is waited for, so only the pids not
+        # reaped yet are kept (and killed at exit)
+        for pid in children[:]:
+            try: done=os.waitpid(pid, os.WNOHANG)[0]
+            except OSError: done=pid
+            if done: children.remove(pid)
+    print "FORKSERVER", path
+    sys.stdout.flush()
+    # accepted connections waiting for their request: deadline
+    waiting={}
+    try:
+        while 1:
+            ins=select.select([listener, sys.stdin]+waiting.keys(), [], [],
+                              1)[0]
+            reap()
+            if sys.stdin in ins:
+                line=sys.stdin.readline()
+                if line.strip() in ('', 'exit', 'quit'): break
+            if listener in ins:
+                conn, addr = listener.accept()
+                waiting[conn]=time.time()+5
+            # a silent client must not hold up the other requests
+            for conn, deadline in waiting.items():
+                if conn not in ins and time.time()>deadline:
+                    del waiting[conn]
+                    conn.close()
+            conn=None
+            for ready in ins:
+                if ready in waiting:
+                    conn=ready
+                    break
+            if conn is None: continue
+            del waiting[conn]
+            try: request=conn.recv(64)
+            except socket.error: request=''
+            if not request.startswith('fork'):
+                conn.close()
+                continue
+            pid=os.fork()
+            if pid:
+                children.append(pid)
+                conn.close()
+                continue
+            # forked engine
+            try:
+                listener.close()
+                for other in waiting: other.close()
+                random.seed()
+                PES=srpyserver.PythonEngineServer(**kwds)
+                conn.sendall("%s %d\n" % (PES.uri, os.getpid()))
+                conn.close()
+                PES.start(threaded=True)
+                parent=os.getppid()
+                while os.getppid()==parent: time.sleep(1)
+            finally:
+                os._exit(0)
+    finally:
+        reap()
+        for pid in children:
+            try: os.kill(pid, signal.SIGTERM)
+            except OSError: pass
+        # wait for them, so they do not outlive us as zombies
+        deadline=time.time()+5
+        while children and time.time()<deadline:
+            time.sleep(0.05)
+            reap()
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except OSError: pass
+        listener.close()
+        os.remove(path)
+
+class ForkServer:
+    """
+    Starts a fork server subprocess (srpyapp.py --forkserver) and gets new
+    python engines from it. The engines are forked from a template process
+    that already went through interpreter start, Pyro initialization and
+    the preloaded imports, so they are ready in milliseconds. Unix only.
+    """
+    
+    def __init__(self, preload=[], timeout=30):
+        """
+        Example:
+        
+        >>> import srpy
+        >>> forkserver = srpy.ForkServer(preload=['numpy'])
+        >>> uri, pid = forkserver.newEngine()
+        >>> engbox = forkserver.newEngBox(8)
+        
+        @param preload: names of the modules the template process imports
+        @type preload: list of strs
+        @param timeout: maximum amount of time to wait for the fork server
+        to start
+        @type timeout: int
+        """
+        import threading
+        from srpyerror import SRPyServerNotFound
+        command=[sys.executable, "-u",
+                 os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "srpyapp.py"), "--forkserver"]
+        if preload: command+=["--preload", ",".join(preload)]
+        self.proc=subprocess.Popen(command, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE)
+        self.path=None
+        def readPath():
+            for line in iter(self.proc.stdout.readline, ''):
+                if line.startswith("FORKSERVER "):
+                    self.path=line.split(" ", 1)[1].strip()
+                    return
+        reader=threading.Thread(target=readPath)
+        reader.setDaemon(True)
+        reader.start()
+        reader.join(timeout)
+        if self.path is None:
+            raise SRPyServerNotFound, "fork server did not start in %ss" % timeout
+    
+    def newEngine(self):
+        """
+        Forks a new python engine.
+        
+        @return: uri id and process id of the new engine
+        @rtype: str, int
+        """
+        import socket
+        conn=socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(self.path)
+            conn.sendall("fork\n")
+            reply=conn.makefile().readline()
+        finally:
+            conn.close()
+        uri, pid = reply.split()
+        return uri, int(pid)
+    
+    def newEngBox(self, n=0, **kwds):
+        """
+        Forks n python engines at once and returns an EngBox connected to
+        them, with their process ids in its 'pids' attribute and the seconds
+        it took to fork and connect them in 'startupTime'.
+        
+        @param n: number of engines, by default one per cpu
+        @type n: int
+        @param kwds: extra arguments for each
+        L{PythonEngine <srpyclient.PythonEngine>}
+        @rtype: L{EngBox <srpyclient.EngBox>}
+        """
+        import threading
+        try: import srpyclient
+        except ImportError: from srpy import srpyclient
+        start=time.time()
+        if n==0: n=detectNCPUs()
+        engines=[None]*n
+        def fork(index): engines[index]=self.newEngine()
+        threads=[threading.Thread(target=fork, args=(i,)) for i in range(n)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        engbox=srpyclient.EngBox([srpyclient.PythonEngine(uri, **kwds)
+                                  for uri, pid in engines])
+        engbox.pids=[pid for uri, pid in engines]
+        engbox.startupTime=time.time()-start
+        return engbox
+    
+    def close(self):
+        """
+        Stops the fork server and all the engines forked from it.
+        
+        @rtype: None
+        """
+        try:
+            self.proc.stdin.write("quit\n")
+            self.proc.stdin.flush()
+        except IOError:
+            pass
+        self.proc.wait()
 
 def detectNCPUs():
     """
@@ -0,0 +1,613 @@
+# Simple Remote Python: http://code.google.com/p/srpy/
+# Copyright (c) 2009, Ricardo Henriques
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the author nor the names of its contributors
+#      may be used to endorse or promote products derived from this software
+#      without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+# THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Asynchronous access to remote python instances from an asyncio event loop
+(trollius on Python 2). Calls are coroutines that share a few pipelined
+connections, so thousands of them can be in flight from a single thread.
+"""
+
+__docformat__="epytext"
+
+import struct, itertools
+
+try:
+    import trollius as asyncio
+    from trollius import From, Return
+except ImportError:
+    asyncio=None
+
+def _coroutine(func):
+    if asyncio is None: return func
+    return asyncio.coroutine(func)
+
+if asyncio is None: _Protocol=object
+else: _Protocol=asyncio.Protocol
+
+class _AsyncConnection(_Protocol):
+    """
+    A Pyro connection as an asyncio protocol. Each call is written with its
+    own request id as soon as it is made, and every reply parsed from the
+    incoming data completes the future of the call with the same id.
+    """
+
+    def __init__(self, loop):
+        import Pyro.core, Pyro.protocol
+        Pyro.core.initClient()
+        self.loop=loop
+        self.adapter=Pyro.protocol.PYROAdapter()
+        self.pending={}
+        self.ids=itertools.count()
+        self.transport=None
+        self.buffer=bytearray()
+        self.frame=None
+        self.state='challenge'
+        self.handshake=None
+        self.paused=False
+        self.drainers=[]
+        self.error=None
+
+    @_coroutine
+    def connect(self, uri):
+        import Pyro.core, Pyro.constants, Pyro.errors
+        self.URI=URI=Pyro.core.PyroURI(uri)
+        if URI.protocol not in ('PYRO', 'PYROLOC'):
+            raise Pyro.errors.ProtocolError('incompatible protocol in URI')
+        self.handshake=asyncio.Future(loop=self.loop)
+        yield From(self.loop.create_connection(lambda: self, URI.address,
+                                               URI.port))
+        yield From(self.handshake)
+        self.objectID=URI.objectID
+        if URI.protocol=='PYROLOC':
+            self.objectID=Pyro.constants.INTERNAL_DAEMON_GUID
+            answer=yield From(self.invoke('ResolvePYROLOC', 0,
+                                          (URI.objectID,)))
+            if isinstance(answer, Pyro.errors.PyroExceptionCapsule):
+                self.close()
+                answer.raiseEx()
+            self.objectID=answer
+
+    def invoke(self, method, flags, args):
+        "Sends a call right away, returns a future for its answer"
+        import Pyro.protocol
+        if self.error is not None: raise self.error
+        requestID=self.ids.next()%(1<<32)
+        body, buffers, pflags = Pyro.protocol._dumps(
+            (self.objectID, method, flags, args), self.adapter.serializer)
+        future=asyncio.Future(loop=self.loop)
+        self.pending[requestID]=future
+        if buffers: pflags|=Pyro.protocol.PFLG_OOB
+        self.transport.write(self.adapter.createMsg(body, pflags, None,
+                                                    requestID))
+        if buffers:
+            descriptors=Pyro.protocol.pickle.dumps([d for d, data in buffers],
+                                                   2)
+            self.transport.write(struct.pack('!L', len(descriptors))
+                                 +descriptors)
+            for descriptor, data in buffers:
+                self.transport.write(memoryview(data))
+        return future
+
+    def drained(self):
+        "Returns a future done when the transport accepts more data"
+        future=asyncio.Future(loop=self.loop)
+        if self.paused: self.drainers.append(future)
+        else: future.set_result(None)
+        return future
+
+    # asyncio protocol callbacks
+
+    def connection_made(self, transport):
+        self.transport=transport
+
+    def data_received(self, data):
+        self.buffer.extend(data)
+        try: self._parse()
+        except Exception, x: self._fail(x)
+
+    def connection_lost(self, exc):
+        import Pyro.constants, Pyro.errors
+        error=Pyro.errors.ConnectionClosedError('connection lost')
+        deny=self.adapter.denyMSG
+        if self.state=='challenge' and self.buffer.startswith(deny):
+            try: reason=Pyro.constants.deniedReasons[int(chr(self.buffer[len(deny)]))]
+            except (KeyError, ValueError, IndexError): reason='invalid response'
+            error=Pyro.errors.ConnectionDeniedError(reason)
+        self._fail(error)
+
+    def pause_writing(self):
+        self.paused=True
+
+    def resume_writing(self):
+        self.paused=False
+        drainers, self.drainers = self.drainers, []
+        for future in drainers:
+            if not future.done(): future.set_result(None)
+
+    def _parse(self):
+        import Pyro.constants, Pyro.errors, Pyro.protocol
+        adapter=self.adapter
+        while True:
+            if self.state=='accept':
+                size=len(adapter.acceptMSG)
+                if len(self.buffer)<size: return
+                msg=str(self.buffer[:size])
+                del self.buffer[:size]
+                if msg!=adapter.acceptMSG:
+                    try: reason=Pyro.constants.deniedReasons[int(msg[-1])]
+                    except (KeyError, ValueError): reason='invalid response'
+                    raise Pyro.errors.ConnectionDeniedError(reason)
+                self.state='replies'
+                self.handshake.set_result(None)
+                continue
+            message=self._nextMessage()
+            if message is None: return
+            body, pflags, requestID = message
+            if self.state=='challenge':
+                if len(body)!=adapter.AUTH_CHALLENGE_SIZE:
+                    raise Pyro.errors.ProtocolError('invalid auth challenge')
+                peer=self.transport.get_extra_info('peername')
+                token=adapter.newConnValidator.createAuthToken(
+                    adapter.ident, body, peer, self.URI, None)
+                self.transport.write(adapter.createMsg(adapter.connectMSG
+                                                       +token))
+                self.state='accept'
+                continue
+            if requestID is None:
+                # not an answer to a call, the server gave up on us
+                raise Pyro.errors.ProtocolError('answer without request id')
+            future=self.pending.pop(requestID, None)
+            if future is None or future.cancelled(): continue
+            try: future.set_result(Pyro.protocol._loads(body, pflags))
+            except Exception, x: future.set_exception(x)
+
+    def _nextMessage(self):
+        # returns (body, pflags, request id) once a whole message is in the
+        # buffer, self.frame keeps what is known of a partial one
+        import Pyro.errors, Pyro.protocol
+        adapter=self.adapter
+        buf=self.buffer
+        if self.frame is None:
+            if len(buf)<adapter.headerSize: return None
+            hid, ver, hsiz, bsiz, pflags, crc = struct.unpack_from(
+                adapter.headerFmt, buffer(buf))
+            if hid!=adapter.headerID or hsiz!=adapter.headerSize \
+               or ver!=adapter.version:
+                raise Pyro.errors.ProtocolError('invalid header')
+            start=adapter.headerSize
+            if pflags&Pyro.protocol.PFLG_REQUESTID: start+=4
+            if pflags&Pyro.protocol.PFLG_COMPRESSPARAMS:
+                start+=Pyro.protocol._compressParamsSize
+            self.frame=[pflags, crc, start, start+bsiz, None]
+        pflags, crc, start, end, oob = self.frame
+        if len(buf)<end: return None
+        total=end
+        if pflags&Pyro.protocol.PFLG_OOB:
+            if oob is None:
+                if len(buf)<end+4: return None
+                size=struct.unpack_from('!L', buffer(buf), end)[0]
+                if len(buf)<end+4+size: return None
+                descriptors=Pyro.protocol.pickle.loads(
+                    str(buf[end+4:end+4+size]))
+                oob=self.frame[4]=(end+4+size, descriptors)
+            total=oob[0]
+            for descriptor in oob[1]:
+                if descriptor[0]=='s': total+=descriptor[1]
+                else: total+=self._arraySize(descriptor)
+            if len(buf)<total: return None
+        requestID=None
+        if pflags&Pyro.protocol.PFLG_REQUESTID:
+            requestID=struct.unpack_from('!L', buffer(buf),
+                                         adapter.headerSize)[0]
+        body=Pyro.protocol._unpackBody(str(buf[start:end]), pflags, crc)
+        if oob is not None:
+            body=Pyro.protocol._OOBBody(body)
+            body.oobBuffers=self._oobBuffers(oob[0], oob[1])
+        del buf[:total]
+        self.frame=None
+        return body, pflags, requestID
+
+    def _arraySize(self, descriptor):
+        import numpy
+        size=numpy.dtype(descriptor[1]).itemsize
+        for n in descriptor[2]: size*=n
+        return size
+
+    def _oobBuffers(self, offset, descriptors):
+        buffers=[]
+        for descriptor in descriptors:
+            if descriptor[0]=='s':
+                buffers.append(str(self.buffer[offset:offset+descriptor[1]]))
+                offset+=descriptor[1]
+                continue
+            import numpy
+            array=numpy.empty(descriptor[2], numpy.dtype(descriptor[1]))
+            array.reshape(-1).view(numpy.uint8)[:]=numpy.frombuffer(
+                self.buffer, numpy.uint8, array.nbytes, offset)
+            offset+=array.nbytes
+            buffers.append(array)
+        return buffers
+
+    def _fail(self, error):
+        if self.error is None: self.error=error
+        pending, self.pending = self.pending, {}
+        waiting=pending.values()+self.drainers
+        self.drainers=[]
+        if self.handshake is not None: waiting.append(self.handshake)
+        for future in waiting:
+            if not future.done(): future.set_exception(error)
+        if self.transport is not None: self.transport.close()
+
+    def close(self):
+        import Pyro.errors
+        self._fail(Pyro.errors.ConnectionClosedError('connection closed'))
+
+class AsyncPythonEngine:
+    """
+    Asynchronous counterpart of L{PythonEngine <srpyclient.PythonEngine>},
+    every remote method is a coroutine. Calls are spread over the
+    connections by number of pending answers, the calls on one connection
+    are pipelined and run on the server in the order they were made.
+    """
+
+    def __init__(self, uri, connections=1, session=None, loop=None):
+        """
+        Prepares the access to a remote python engine, the connections are
+        opened by L{connect} or by the first call.
+        
+        Example:
+        
+        >>> import srpy, trollius
+        >>> from trollius import From
+        >>> uri, proc = srpy.newSubEngine()
+        >>> @trollius.coroutine
+        ... def main():
+        ...     pyeng = srpy.AsyncPythonEngine(uri)
+        ...     yield From(pyeng.set(a=2))
+        ...     results = yield From(trollius.gather(
+        ...         *[pyeng.eval('a*%d' % i) for i in range(1000)]))
+        ...     pyeng.close()
+        ...     print results[21]
+        >>> trollius.get_event_loop().run_until_complete(main())
+        42
+        
+        @param uri: remote PythonEngine identifier
+        @type uri: str
+        @param connections: number of connections to open, calls on
+        different connections run concurrently on the server
+        @type connections: int
+        @param session: handle of a remote session to work on
+        @type session: str
+        @param loop: event loop, by default the current one
+        @type loop: trollius.AbstractEventLoop
+        """
+        if asyncio is None:
+            raise ImportError("AsyncPythonEngine needs trollius "
+                              "(pip install trollius)")
+        if connections<1: raise ValueError, "connections must be at least 1"
+        self.uri=uri
+        self.session=session
+        self.connections=connections
+        self.loop=loop or asyncio.get_event_loop()
+        self._conns=[]
+        # connections borrowed from the engine that created this session
+        self._shared=False
+        self._connecting=None
+
+    @_coroutine
+    def connect(self):
+        """
+        Opens the connections to the remote engine.
+        
+        @rtype: None
+        """
+        if self._conns: return
+        if self._connecting is None:
+            self._connecting=asyncio.ensure_future(self._connect(),
+                                                   loop=self.loop)
+        try: yield From(asyncio.shield(self._connecting, loop=self.loop))
+        except Exception:
+            self._connecting=None
+            raise
+
+    @_coroutine
+    def _connect(self):
+        conns=[_AsyncConnection(self.loop) for i in range(self.connections)]
+        try:
+            yield From(asyncio.gather(*[conn.connect(self.uri)
+                                        for conn in conns], loop=self.loop))
+        except Exception:
+            for conn in conns: conn.close()
+            raise
+        self._conns=conns
+
+    @_coroutine
+    def invoke(self, method, *args, **kwds):
+        """
+        Calls a method of the remote engine.
+        
+        @param method: name of the server-side PythonEngine method
+        @type method: str
+        @rtype: any
+        """
+        import Pyro.constants
+        if not self._conns: yield From(self.connect())
+        import Pyro.errors
+        # the call is sent before yielding, so the next one sees it pending
+        conn=min(self._conns, key=lambda conn: len(conn.pending))
+        future=conn.invoke(method, Pyro.constants.RIF_VarargsAndKeywords,
+                           (args, kwds))
+        if conn.paused: yield From(conn.drained())
+        result=yield From(future)
+        if isinstance(result, Pyro.errors.PyroExceptionCapsule):
+            result.raiseEx()
+        raise Return(result)
+
+    @_coroutine
+    def set(self, **vars):
+        """
+        Creates variables on the Python side in a single call.
+        
+        @param vars: the variables to be transfered
+        @type vars: kwd dict
+        @rtype: None
+        """
+        yield From(self.invoke('setmany', vars, session=self.session))
+
+    @_coroutine
+    def get(self, vars=None):
+        """
+        Gets variables from the Python side, see
+        L{PythonEngine.get <srpyclient.PythonEngine.get>}.
+        
+        @type vars: None or str or list
+        @rtype: any
+        """
+        if vars is None:
+            result=yield From(self.invoke('list', session=self.session))
+        elif isinstance(vars, str):
+            result=yield From(self.invoke('get', vars, session=self.session))
+        else:
+            result=yield From(self.invoke('getmany', list(vars),
+                                          session=self.session))
+        raise Return(result)
+
+    @_coroutine
+    def eval(self, cmd, **vars):
+        """
+        Evaluates an expression on the Python side, after setting vars.
+        
+        @param cmd: expression to evaluate
+        @type cmd: str
+        @rtype: any
+        """
+        if vars: yield From(self.set(**vars))
+        result=yield From(self.invoke('eval', cmd, session=self.session))
+        raise Return(result)
+
+    @_coroutine
+    def exe(self, cmd, **vars):
+        """
+        Executes code on the Python side, after setting vars.
+        
+        @param cmd: code to execute
+        @type cmd: str
+        @rtype: None
+        """
+        if vars: yield From(self.set(**vars))
+        yield From(self.invoke('exe', cmd, session=self.session))
+
+    @_coroutine
+    def vexe(self, cmd, get=[], **vars):
+        """
+        Executes code in a temporary namespace holding vars and returns the
+        variables named in get, see
+        L{PythonEngine.vexe <srpyclient.PythonEngine.vexe>}.
+        
+        @rtype: dict
+        """
+        result=yield From(self.invoke('vexe', cmd, get, **vars))
+        raise Return(result)
+
+    @_coroutine
+    def apply(self, func_name, *args, **kwds):
+        """
+        Calls a module level function by its dotted name, outside of the
+        remote namespace.
+        
+        @type func_name: str
+        @rtype: any
+        """
+        result=yield From(self.invoke('apply', func_name, args, kwds))
+        raise Return(result)
+
+    @_coroutine
+    def call(self, func_name, *args, **kwds):
+        """
+        Calls a function of the remote namespace by its dotted name.
+        
+        @type func_name: str
+        @rtype: any
+        """
+        result=yield From(self.invoke('call', func_name, args, kwds,
+                                      session=self.session))
+        raise Return(result)
+
+    @_coroutine
+    def ping(self):
+        """
+        Checks the remote engine is alive.
+        
+        @rtype: bool
+        """
+        result=yield From(self.invoke('ping'))
+        raise Return(result)
+
+    @_coroutine
+    def whoami(self):
+        """
+        Returns a dictionary with information about the remote engine.
+        
+        @rtype: dict
+        """
+        result=yield From(self.invoke('whoami'))
+        raise Return(result)
+
+    @_coroutine
+    def newSession(self):
+        """
+        Creates a new isolated namespace on the remote side and returns an
+        AsyncPythonEngine working on it over the same connections, which
+        stay open until this engine is closed (closing the session engine
+        only detaches it from them).
+        
+        @rtype: L{AsyncPythonEngine}
+        """
+        session=yield From(self.invoke('create_session'))
+        pyeng=AsyncPythonEngine(self.uri, self.connections, session,
+                                self.loop)
+        pyeng._conns=self._conns
+        pyeng._shared=True
+        raise Return(pyeng)
+
+    def close(self):
+        """
+        Closes the connections, pending calls fail with
+        ConnectionClosedError. An engine returned by L{newSession} only lets
+        go of the connections it shares with its creator.
+        
+        @rtype: None
+        """
+        if not self._shared:
+            for conn in self._conns: conn.close()
+        self._conns=[]
+        self._shared=False
+
+    def __repr__(self):
+        return "<AsyncPythonEngine for %s>" % self.uri
+
+class AsyncEngBox:
+    """
+    Asynchronous counterpart of L{EngBox <srpyclient.EngBox>}, runs calls on
+    several AsyncPythonEngine(s) at once from one event loop.
+    """
+
+    def __init__(self, pyengs=[]):
+        """
+        @param pyengs: engines to manage
+        @type pyengs: list of L{AsyncPythonEngine}
+        """
+        self._engines_=list(pyengs)
+
+    def append(self, pyeng):
+        """
+        Adds an AsyncPythonEngine to the box.
+        
+        @type pyeng: L{AsyncPythonEngine}
+        @rtype: None
+        """
+        self._engines_.append(pyeng)
+
+    def __len__(self):
+        return len(self._engines_)
+
+    def __iter__(self):
+        return iter(self._engines_)
+
+    def __getitem__(self, index):
+        return self._engines_[index]
+
+    @_coroutine
+    def connect(self):
+        """
+        Connects all the engines concurrently.
+        
+        @rtype: None
+        """
+        yield From(asyncio.gather(*[pyeng.connect() for pyeng in self]))
+
+    @_coroutine
+    def run(self, method, *args, **kwds):
+        """
+        Calls the same method on every engine concurrently.
+        
+        Example:
+        
+        >>> box = srpy.AsyncEngBox([srpy.AsyncPythonEngine(uri)
+        ...                         for uri in uris])
+        >>> hosts = yield From(box.run('eval', 'platform.node()'))
+        
+        @param method: name of an L{AsyncPythonEngine} method
+        @type method: str
+        @return: the results, in engine order
+        @rtype: list
+        """
+        results=yield From(asyncio.gather(
+            *[getattr(pyeng, method)(*args, **kwds) for pyeng in self]))
+        raise Return(list(results))
+
+    @_coroutine
+    def map(self, func_name, iterable, chunksize=1):
+        """
+        Like L{EngBox.map <srpyclient.EngBox.map>}: applies a module level
+        function, given by its dotted name, to every item, sending chunks of
+        items to whichever engine is free.
+        
+        @type func_name: str
+        @type iterable: iterable
+        @param chunksize: number of items sent in each call
+        @type chunksize: int
+        @rtype: list
+        """
+        if len(self)==0: raise ValueError, "AsyncEngBox has no engines"
+        if chunksize<1: raise ValueError, "chunksize must be at least 1"
+        module=func_name.rpartition('.')[0]
+        code='__results__ = map(%s, __chunk__)' % func_name
+        if module: code='import %s\n%s' % (module, code)
+        items=iter(iterable)
+        chunks={}
+        counter=itertools.count()
+        @_coroutine
+        def work(pyeng):
+            while True:
+                chunk=list(itertools.islice(items, chunksize))
+                if not chunk: return
+                index=counter.next()
+                result=yield From(pyeng.vexe(code, ['__results__'],
+                                             __chunk__=chunk))
+                chunks[index]=result['__results__']
+        yield From(asyncio.gather(*[work(pyeng) for pyeng in self]))
+        results=[]
+        for index in sorted(chunks): results.extend(chunks[index])
+        raise Return(results)
+
+    def close(self):
+        """
+        Closes the connections of every engine.
+        
+        @rtype: None
+        """
+        for pyeng in self: pyeng.close()
@@ -58,3 +58,74 @@ def isprime(n):
 def sum_primes(n):
     """Calculates sum of all primes below given integer n"""
     return sum([x for x in xrange(2,n) if isprime(x)])
+
+def transferBenchmark(pyeng, sizes=(1, 10, 100, 1000)):
+    """Compares variable transfer one remote call per variable against the
+    batched PythonEngine.set/get transfer.
+    pyeng -> connected srpyclient.PythonEngine
+    sizes -> number of variables to move in each run
+    Returns a list of dictionaries, one per size, with the number of round
+    trips and the wall time for each transfer strategy.
+    Ex:
+    transferBenchmark(pyeng, sizes=(10,)) will return
+    [{'nvars': 10, 'single_trips': 20, 'single_time': ...,
+      'batch_trips': 2, 'batch_time': ...}]
+    """
+    results=[]
+    for n in sizes:
+        vars={}
+        for i in xrange(n): vars['__bench%d__' % i]=i
+        names=vars.keys()
+        session=pyeng.session
+        def single():
+            for name in names: pyeng.py.set(name, vars[name], session=session)
+            for name in names: pyeng.py.get(name, session=session)
+        def batch():
+            pyeng.set(**vars)
+            pyeng.get(names)
+        single_time=execTime(single)[0]
+        batch_time=execTime(batch)[0]
+        pyeng.exe('for __n__ in %r: del globals()[__n__]\ndel __n__' % names)
+        results.append({'nvars': n,
+                        'single_trips': 2*n, 'single_time': single_time,
+                        'batch_trips': 2, 'batch_time': batch_time})
+    return results
+
+def serializerBenchmark(pyeng, cycles=1000, payload=None,
+                        serializers=('pickle', 'marshal', 'binary')):
+    """Measures the latency of a small remote call with each wire
+    serializer, next to the time cPickle protocol 2 alone takes to encode
+    and decode the same payload.
+    pyeng       -> connected srpyclient.PythonEngine
+    cycles      -> number of calls per serializer
+    payload     -> value sent and received back by each call
+    serializers -> names of the serializers to compare
+    Returns a dictionary serializer_name: (seconds per call, encoded size),
+    the 'cPickle2' entry holding the local dumps+loads time.
+    Ex:
+    serializerBenchmark(pyeng, 100) will return
+    {'pickle': (0.0004, 98), 'marshal': (0.0003, 73), ...}
+    """
+    import cPickle
+    import Pyro.protocol
+    if payload is None:
+        payload={'id': 7, 'name': 'srpy', 'values': [1.5, 2.5, 3.5]}
+    results={}
+    def local():
+        for i in xrange(cycles): cPickle.loads(cPickle.dumps(payload, 2))
+    results['cPickle2']=(execTime(local)[0]/cycles,
+                         len(cPickle.dumps(payload, 2)))
+    pyeng.set(__bench__=payload)
+    try:
+        for name in serializers:
+            pyeng.setSerializer(name)
+            def remote():
+                for i in xrange(cycles):
+                    pyeng.py.get('__bench__', session=pyeng.session)
+            remote()
+            body=Pyro.protocol._dumps(payload, name)[0]
+            results[name]=(execTime(remote)[0]/cycles, len(body))
+    finally:
+        pyeng.setSerializer('pickle')
+        pyeng.exe('del __bench__')
+    return results
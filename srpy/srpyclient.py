@@ -36,7 +36,10 @@ class PythonEngine:
     variable exchange and code running.
     """
     
-    def __init__(self, uri, name='', group=''):
+    _nsttl_=5    # seconds a NameSpace description is trusted
+    
+    def __init__(self, uri, name='', group='', pool=None, connections=1,
+                 session=None):
         """
         Connects to a remote python engine.
         
@@ -52,6 +55,17 @@ class PythonEngine:
         @type name: str
         @param group: reference group for this PythonEngine
         @type group: str
+        @param pool: worker pool used by the asynchronous methods, if None
+        the pool shared by all PythonEngine(s) is used
+        @type pool: L{WorkerPool <srpyfuture.WorkerPool>}
+        @param connections: maximum number of connections kept open to the
+        remote engine, with more than one connection calls from several
+        threads run concurrently instead of waiting for each other
+        @type connections: int
+        @param session: handle of a remote session to work on, if None the
+        default namespace shared with other clients is used,
+        see L{newSession}
+        @type session: str
         """
         try: import Pyro
         except ImportError:
@@ -62,10 +76,25 @@ class PythonEngine:
         import Pyro.core, thread
         from srpyerror import SRPyServerNotFound
         from srpydynamic import NameSpace
-        self.py=Pyro.core.getProxyForURI(uri)
+        if connections>1:
+            from srpypool import ProxyPool
+            self.py=ProxyPool(uri, connections)
+        else: self.py=Pyro.core.getProxyForURI(uri)
         self.uri=uri
         self.name=name
         self.group=group
+        self.pool=pool
+        self.session=session
+        self.connections=connections
+        # separate proxy with a socket timeout, see heartbeat
+        self._heartbeat_=None
+        self._heartbeatlock_=thread.allocate_lock()
+        # asynchronous calls not finished yet, see load
+        self._pending_=0
+        self._pendinglock_=thread.allocate_lock()
+        # NameSpace cache: dotted name: (kind, doc, namespace version, time)
+        self._nscache_={}
+        self._nsversion_=0
         self.ns=NameSpace(self)
         # Test connection and get info
         self.info=self.py.whoami()
@@ -78,7 +107,8 @@ class PythonEngine:
             
     def set(self, **vars):
         """
-        Creates variables on the Python side.
+        Creates variables on the Python side. All the variables are
+        transfered together in a single remote call.
 
         Example:
         
@@ -96,15 +126,15 @@ class PythonEngine:
         @rtype: None
         """
         import Pyro.util
-        for var_name in vars.keys():
-            try: self.py.set(var_name, vars[var_name])
-            except Exception, x:
-                print ''.join(Pyro.util.getPyroTraceback(x))
-                raise
+        try: self._seenVersion(self.py.setmany(vars, session=self.session))
+        except Exception, x:
+            print ''.join(Pyro.util.getPyroTraceback(x))
+            raise
                 
     def get(self, vars=None):
         """
-        Gets variables from the Python side.
+        Gets variables from the Python side. When a list of names is given
+        all the variables are retrieved together in a single remote call.
         
         Example:
         
@@ -131,17 +161,137 @@ class PythonEngine:
         import types
         import Pyro.util
         try:
-            if vars==None: return self.py.list()
-            if type(vars)==types.StringType: return self.py.get(vars)
-            else:
-                pyvars={}
-                for var in vars:
-                    pyvars[var]=self.py.get(var)
-                return pyvars
+            if vars==None: return self.py.list(session=self.session)
+            if type(vars)==types.StringType: return self.py.get(vars, session=self.session)
+            else: return self.py.getmany(list(vars),
+                                            session=self.session)
+        except Exception, x:
+            print ''.join(Pyro.util.getPyroTraceback(x)) 
+            raise
+        
+    def copy_to(self, other, names):
+        """
+        Copies variables of this PythonEngine straight to another one,
+        the remote engine connects to the other and pushes the values
+        without going through the client.
+        
+        Example:
+        
+        >>> import srpy
+        >>> pyeng1 = srpy.PythonEngine(srpy.newSubEngine()[0])
+        >>> pyeng2 = srpy.PythonEngine(srpy.newSubEngine()[0])
+        >>> pyeng1.set(a=5, b=3)
+        >>> pyeng1.copy_to(pyeng2, ['a', 'b'])
+        >>> pyeng2.get(['a', 'b'])
+        {'a': 5, 'b': 3}
+        
+        @param other: PythonEngine, or its uri id, to copy the variables to
+        @type other: L{PythonEngine} or str
+        @param names: names of the variables
+        @type names: str or list of strs
+        @rtype: None
+        """
+        import types
+        import Pyro.util
+        if type(names)==types.StringType: names=[names]
+        if isinstance(other, PythonEngine):
+            uri, session = str(other.uri), other.session
+        else: uri, session = str(other), None
+        try: version=self.py.copy_to(uri, list(names), session=self.session,
+                                     peer_session=session)
         except Exception, x:
             print ''.join(Pyro.util.getPyroTraceback(x)) 
             raise
+        if isinstance(other, PythonEngine) and version is not None:
+            other._seenVersion(version)
         
+    def get_stream(self, var_name, chunksize=1<<20):
+        """
+        Gets a variable from the Python side in chunks of about chunksize
+        bytes, each one fetched when the previous was consumed. Neither side
+        holds more than one chunk in memory for transfer. Arrays are
+        streamed as 1-D pieces of their flattened (C ordered) data, strings
+        as substrings and any other object as pieces of its pickle (which
+        the server keeps whole while the stream is open). The returned
+        L{Stream} tells which one it is, and the dtype and shape of arrays,
+        so the chunks can be given to L{set_stream}.
+        
+        Example:
+        
+        >>> import srpy, numpy
+        >>> uri, proc = srpy.newSubEngine()
+        >>> pyeng = srpy.PythonEngine(uri)
+        >>> pyeng.set(a=numpy.arange(10))
+        >>> stream = pyeng.get_stream('a', chunksize=32)
+        >>> stream.kind, stream.shape
+        ('array', (10,))
+        >>> [list(chunk) for chunk in stream]
+        [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+        >>> stream = pyeng.get_stream('a')
+        >>> pyeng.set_stream('b', stream, stream.dtype, stream.shape)
+        
+        @param var_name: name of the variable
+        @type var_name: str
+        @param chunksize: approximate size of each chunk in bytes
+        @type chunksize: int
+        @rtype: L{Stream}
+        """
+        import Pyro.util
+        try:
+            handle, kind, info = self.py.stream_get(var_name, chunksize,
+                                                    session=self.session)
+        except Exception, x:
+            print ''.join(Pyro.util.getPyroTraceback(x))
+            raise
+        return Stream(self, handle, kind, info)
+
+    def set_stream(self, var_name, iterable, dtype=None, shape=None):
+        """
+        Creates a variable on the Python side from an iterable of chunks,
+        sending each one after the previous was received. The variable is
+        only set once all the chunks were transfered. Without dtype the
+        chunks must be strings and are joined. With dtype the chunks are
+        converted to arrays, which are filled in place when the shape is
+        known and concatenated at the end otherwise.
+        
+        Example:
+        
+        >>> import srpy, numpy
+        >>> uri, proc = srpy.newSubEngine()
+        >>> pyeng = srpy.PythonEngine(uri)
+        >>> pyeng.set_stream('a', (range(i, i+5) for i in (0, 5)), 'i4', (2, 5))
+        >>> pyeng.get('a')
+        array([[0, 1, 2, 3, 4],
+               [5, 6, 7, 8, 9]])
+        
+        @param var_name: name of the variable
+        @type var_name: str
+        @param iterable: the chunks to be transfered
+        @type iterable: iterable
+        @param dtype: dtype of the array to assemble, None for a str
+        @type dtype: None or str or numpy.dtype
+        @param shape: shape of the array to assemble
+        @type shape: None or tuple
+        @rtype: None
+        """
+        import Pyro.util
+        if dtype is not None:
+            import numpy
+            dtype=numpy.dtype(dtype).str
+        try:
+            handle=self.py.stream_set(var_name, dtype, shape,
+                                      session=self.session)
+            try:
+                for chunk in iterable: self.py.stream_write(handle, chunk)
+            except:
+                self.py.stream_close(handle)
+                raise
+            self._seenVersion(self.py.stream_commit(handle,
+                                                    session=self.session))
+        except Exception, x:
+            print ''.join(Pyro.util.getPyroTraceback(x))
+            raise
+
     def clear(self):
         """
         Cleans namespace (deleting variable) on the remote Python side
@@ -160,11 +310,53 @@ class PythonEngine:
         
         @rtype: None
         """
-        try: self.py.clear()
+        try: self._seenVersion(self.py.clear(session=self.session))
         except Exception, x:
             print ''.join(Pyro.util.getPyroTraceback(x)) 
             raise
 
+    def newSession(self):
+        """
+        Creates a new isolated namespace on the remote Python side and returns
+        a PythonEngine working on it. Calls on different sessions of the same
+        server don't share variables and don't wait for each other.
+        
+        Example:
+        
+        >>> import srpy
+        >>> uri, proc = srpy.newSubEngine()
+        >>> pyeng = srpy.PythonEngine(uri)
+        >>> job = pyeng.newSession()
+        >>> job.set(a=1)
+        >>> pyeng.get()
+        []
+        >>> job.get()
+        ['a']
+        >>> job.closeSession()
+        
+        @rtype: PythonEngine
+        """
+        import Pyro.util
+        try: session=self.py.create_session()
+        except Exception, x:
+            print ''.join(Pyro.util.getPyroTraceback(x))
+            raise
+        return PythonEngine(self.uri, self.name, self.group, self.pool,
+                            self.connections, session)
+
+    def closeSession(self):
+        """
+        Deletes the remote session created by L{newSession} and all its
+        variables.
+        
+        @rtype: None
+        """
+        import Pyro.util
+        try: self.py.close_session(self.session)
+        except Exception, x:
+            print ''.join(Pyro.util.getPyroTraceback(x))
+            raise
+
     def eval(self, cmd, **vars):
         """
         Evaluates cmd in the Python side and returns its value
@@ -188,7 +380,7 @@ class PythonEngine:
         import Pyro.util
         if vars!={}: self.set(**vars)
         try:
-            result=self.py.eval(cmd)
+            result=self.py.eval(cmd, session=self.session)
             return result
         except Exception, x:
             print ''.join(Pyro.util.getPyroTraceback(x))
@@ -215,14 +407,16 @@ class PythonEngine:
         """
         import Pyro.util
         if vars!={}: self.set(**vars)
-        try: self.py.exe(cmd)
+        try: self._seenVersion(self.py.exe(cmd, session=self.session))
         except Exception, x:
             print ''.join(Pyro.util.getPyroTraceback(x))
             raise
             
     def vexe(self, cmd, get=[], **vars):
         """Similar to exe method but all variables are runned in a temporary
-        independent namespace and will be deleted after execution.
+        independent namespace and will be deleted after execution. On servers
+        started with a process pool (srpyapp.py --pool) it runs on the server
+        worker processes.
         
         Example:
         
@@ -248,6 +442,166 @@ class PythonEngine:
             print ''.join(Pyro.util.getPyroTraceback(x))
             raise
 
+    def apply(self, func_name, *args, **kwds):
+        """
+        Calls a builtin or importable function on the Python side and returns
+        its value. The function doesn't see the remote namespace, on servers
+        started with a process pool (srpyapp.py --pool) calls run on the
+        server worker processes and use all of its cpus.
+        
+        Example:
+        
+        >>> import srpy
+        >>> uri, proc = srpy.newSubEngine()
+        >>> pyeng = srpy.PythonEngine(uri)
+        >>> pyeng.apply('math.pow', 2, 10)
+        1024.0
+        
+        @param func_name: dotted function name (eg: 'math.pow')
+        @type func_name: str
+        @param args: function arguments
+        @type args: arg list
+        @param kwds: function keywords
+        @type kwds: kwd dict
+        @return: function return value
+        @rtype: any
+        """
+        import Pyro.util
+        try: return self.py.apply(func_name, args, kwds)
+        except Exception, x:
+            print ''.join(Pyro.util.getPyroTraceback(x))
+            raise
+
+    def apply_async(self, func_name, *args, **kwds):
+        """
+        Asynchronous version of L{apply}, returns immediately.
+        
+        @param func_name: dotted function name (eg: 'math.pow')
+        @type func_name: str
+        @rtype: L{Future <srpyfuture.Future>}
+        """
+        return self._submit(self.apply, func_name, *args, **kwds)
+
+    def eval_async(self, cmd, **vars):
+        """
+        Asynchronous version of L{eval}, returns immediately. Note that
+        C{vars} are set in the shared remote namespace, use L{vexe_async} to
+        keep concurrent calls apart.
+        
+        Example:
+        
+        >>> import srpy
+        >>> uri, proc = srpy.newSubEngine()
+        >>> pyeng = srpy.PythonEngine(uri)
+        >>> future = pyeng.eval_async("a+b", a=2, b=3)
+        >>> future.result(timeout=10)
+        5
+        
+        @param cmd: python expression
+        @type cmd: str
+        @param vars: any variables that need to be set before evaluating 'cmd'
+        @type vars: kwd dict
+        @return: future remote evaluation result
+        @rtype: L{Future <srpyfuture.Future>}
+        """
+        return self._submit(self.eval, cmd, **vars)
+
+    def exe_async(self, cmd, **vars):
+        """
+        Asynchronous version of L{exe}, returns immediately.
+        
+        @param cmd: python expression
+        @type cmd: str
+        @param vars: any variables that need to be set before evaluating 'cmd'
+        @type vars: kwd dict
+        @rtype: L{Future <srpyfuture.Future>}
+        """
+        return self._submit(self.exe, cmd, **vars)
+
+    def vexe_async(self, cmd, get=[], **vars):
+        """
+        Asynchronous version of L{vexe}, returns immediately.
+        
+        Example:
+        
+        >>> import srpy
+        >>> uri, proc = srpy.newSubEngine()
+        >>> pyeng = srpy.PythonEngine(uri)
+        >>> future = pyeng.vexe_async('b=a**2', get=['b'], a=3)
+        >>> future.add_done_callback(lambda f: f.result())
+        >>> future.result()
+        {'b': 9}
+        
+        @param cmd: python expression
+        @type cmd: str
+        @param get: list of variables to retrieve
+        @type get: list
+        @param vars: any variables that need to be set before evaluating C{cmd}
+        @type vars: kwd dict
+        @return: future variables mentioned in C{get}
+        @rtype: L{Future <srpyfuture.Future>}
+        """
+        return self._submit(self.vexe, cmd, get, **vars)
+
+    def get_async(self, vars=None):
+        """
+        Asynchronous version of L{get}, returns immediately.
+        
+        @type vars: None or str or list
+        @rtype: L{Future <srpyfuture.Future>}
+        """
+        return self._submit(self.get, vars)
+
+    def _submit(self, func, *args, **kwds):
+        import srpyfuture
+        pool=self.pool
+        if pool is None: pool=srpyfuture.getDefaultPool()
+        return self._submitTo(pool, func, *args, **kwds)
+
+    def _submitTo(self, pool, func, *args, **kwds):
+        self._addPending(1)
+        future=pool.submit(func, *args, **kwds)
+        future.add_done_callback(lambda future: self._addPending(-1))
+        return future
+
+    def _addPending(self, n):
+        self._pendinglock_.acquire()
+        self._pending_+=n
+        self._pendinglock_.release()
+
+    def load(self):
+        """
+        Returns the number of asynchronous calls (the '_async' methods and
+        EngBox.mrp) this client made to the PythonEngine that did not finish
+        yet.
+        
+        @rtype: int
+        """
+        return self._pending_
+
+    def batch(self):
+        """
+        Returns a L{Batch} that records calls to the methods of the remote
+        engine and pipelines them: all are sent back to back over one
+        connection and their results are collected as they arrive, taking
+        about one round trip for the whole batch instead of one per call.
+        
+        Example:
+        
+        >>> import srpy
+        >>> uri, proc = srpy.newSubEngine()
+        >>> pyeng = srpy.PythonEngine(uri)
+        >>> batch = pyeng.batch()
+        >>> batch.set('a', 2)
+        >>> batch.eval('a*21')
+        >>> batch.get('a')
+        >>> batch.run()[1:]
+        [42, 2]
+        
+        @rtype: L{Batch}
+        """
+        return Batch(self)
+
     def install(self, *modules):
         """Install modules in the Python server, will be erased on server
         shutdown.
@@ -268,7 +622,8 @@ class PythonEngine:
             modfile=imp.find_module(mod)[1]
             modname=os.path.split(modfile)[1]
             modtxt=open(modfile).read()
-            try: self.py.install(modname, modtxt)
+            try: self._seenVersion(self.py.install(modname, modtxt,
+                                                   session=self.session))
             except Exception, x:
                 print ''.join(Pyro.util.getPyroTraceback(x))
                 raise
@@ -309,13 +664,51 @@ class PythonEngine:
         >>> print pyeng.ns.math.sqrt(3)
         1.73205080757
         
+        Modules and functions found through ns are described again when
+        this client changes the namespace or after _nsttl_ seconds, so
+        changes made by other clients show up within that time.
+        
         @rtype: any
         """
         pass
     
+    def call(self, func_name, *args, **kwds):
+        """
+        Calls a function of the remote namespace in a single remote call and
+        returns its value, the arguments are passed directly to the function
+        without being set in the namespace.
+        
+        Example:
+        
+        >>> import srpy
+        >>> uri, proc = srpy.newSubEngine()
+        >>> pyeng = srpy.PythonEngine(uri)
+        >>> pyeng.imp('math')
+        >>> pyeng.call('math.sqrt', 9)
+        3.0
+        
+        @param func_name: dotted name of the function in the remote namespace
+        or of a builtin function
+        @type func_name: str
+        @param args: function arguments
+        @type args: arg list
+        @param kwds: function keywords
+        @type kwds: kwd dict
+        @return: function return value
+        @rtype: any
+        """
+        return self._call(func_name, args, kwds)
+
+    def _call(self, func_name, args, kwds):
+        import Pyro.util
+        try: return self.py.call(func_name, args, kwds, session=self.session)
+        except Exception, x:
+            print ''.join(Pyro.util.getPyroTraceback(x))
+            raise
+
     def associateFunction(self, func_name):
         """Dynamically generates a new local method that returns the same as
-        a Python server function.
+        a Python server function. Each call is a single remote L{call}.
         
         Example:
         
@@ -332,15 +725,22 @@ class PythonEngine:
         @return: proxy to remote function
         @rtype: function
         """
-        #import random
-        #argnames=str(random.randint(1000))
-        f=lambda *args, **kwds: self.eval('%s(*__args__, **__kwds__)' % func_name,
-                                          __args__=args, __kwds__=kwds)
-        f.__doc__=self.eval('%s.__doc__' % func_name)
+        return self._remoteFunction(func_name,
+                                    self.eval('%s.__doc__' % func_name))
+
+    def _remoteFunction(self, func_name, doc):
+        f=lambda *args, **kwds: self._call(func_name, args, kwds)
+        f.__doc__=doc
         f.__repr__=lambda: '<Remote Function %s in %s>' % (func_name, self.uri)
         f.__name__=func_name
         return f
     
+    def _seenVersion(self, version):
+        # remote namespace versions only grow, older NameSpace cache entries
+        # are ignored once a newer version is seen
+        if version is not None and version>self._nsversion_:
+            self._nsversion_=version
+
     def whoami(self):
         """Return information about the remote server.
         
@@ -425,7 +825,7 @@ class PythonEngine:
         
         @rtype: bool
         """
-        return self.py.isBusy()
+        return self.py.isBusy(session=self.session)
 
     def wait(self, timeout=None):
         """
@@ -433,7 +833,7 @@ class PythonEngine:
         
         @rtype: None
         """
-        self.py.wait(timeout)
+        self.py.wait(timeout, session=self.session)
         
     def ping(self):
         """
@@ -456,6 +856,149 @@ class PythonEngine:
         #    print ''.join(Pyro.util.getPyroTraceback(x))
         return self.py.ping()
     
+    def heartbeat(self, timeout=5):
+        """
+        Pings the Python server on a connection of its own with a socket
+        timeout, so a hung or busy connection of the PythonEngine does not
+        delay the answer.
+        
+        Example:
+
+        >>> import srpy
+        >>> uri, proc = srpy.newSubEngine()
+        >>> pyeng = srpy.PythonEngine(uri)             
+        >>> pyeng.heartbeat() < 1
+        True
+        
+        @param timeout: seconds to wait for the server
+        @type timeout: float
+        @return: round trip time in seconds
+        @rtype: float
+        """
+        import Pyro.core, time
+        self._heartbeatlock_.acquire()
+        try:
+            if self._heartbeat_ is None:
+                self._heartbeat_=Pyro.core.getProxyForURI(self.uri)
+            self._heartbeat_._setTimeout(timeout)
+            start=time.time()
+            try: self._heartbeat_.ping()
+            except:
+                # reconnect on the next heartbeat
+                self._heartbeat_._release()
+                self._heartbeat_=None
+                raise
+            return time.time()-start
+        finally:
+            self._heartbeatlock_.release()
+    
+    def cacheStats(self):
+        """
+        Returns statistics of the server cache of compiled code, strings run
+        with L{exe}, L{eval} and L{vexe} are only compiled the first time.
+        
+        Example:
+        
+        >>> import srpy
+        >>> uri, proc = srpy.newSubEngine()
+        >>> pyeng = srpy.PythonEngine(uri)
+        >>> for n in range(10): pyeng.eval('1+1')
+        >>> pyeng.cacheStats()
+        {'hits': 9, 'misses': 1, 'size': 1, 'maxsize': 256}
+        
+        @rtype: dict
+        """
+        return self.py.cacheStats()
+
+    def getPoolStats(self):
+        """
+        Returns the connection pool metrics, see L{srpypool.ProxyPool.getStats}.
+        
+        @return: pool metrics or None if the PythonEngine was created with
+        a single connection
+        @rtype: dict
+        """
+        from srpypool import ProxyPool
+        if isinstance(self.py, ProxyPool): return self.py.getStats()
+        return None
+
+    def setSerializer(self, name):
+        """
+        Chooses how the calls to this PythonEngine are encoded. The engine
+        answers with the same serializer, and any message that can't be
+        encoded by it exactly goes as pickle. 'marshal' has the lowest
+        latency but must only be used between trusted hosts. 'binary' is a
+        compact codec for None, bool, numbers, strings, tuples, lists and
+        dicts that is safe to decode from untrusted hosts, it is slower
+        than pickle as it is written in Python.
+        
+        Example:
+        
+        >>> import srpy
+        >>> uri, proc = srpy.newSubEngine()
+        >>> pyeng = srpy.PythonEngine(uri)
+        >>> pyeng.setSerializer('marshal')
+        >>> pyeng.set(a=[1, 2.5, 'x'])
+        >>> pyeng.get('a')
+        [1, 2.5, 'x']
+        
+        @param name: 'pickle', 'marshal', 'binary' or any serializer added
+        with Pyro.protocol.registerSerializer
+        @type name: str
+        @rtype: None
+        """
+        self.py._setSerializer(name)
+
+    def setCompression(self, codec='zlib', level=6, threshold=1024,
+                       bandwidth=None):
+        """
+        Compresses the calls to this PythonEngine, which answers with the
+        same codec. Messages smaller than threshold bytes are sent as they
+        are, and so are large messages whose sample doesn't compress. Given
+        the link bandwidth, compression is also skipped while the CPU time
+        it takes is worth more than the bytes it saves, so it pays on WAN
+        links and backs off on fast LANs. See L{compressionStats}.
+        
+        Example:
+        
+        >>> import srpy
+        >>> uri, proc = srpy.newSubEngine()
+        >>> pyeng = srpy.PythonEngine(uri)
+        >>> pyeng.setCompression('zlib', level=1, bandwidth=10e6/8)
+        >>> pyeng.set(a='srpy'*10000)
+        >>> pyeng.compressionStats()['saved']
+        39769
+        
+        @param codec: 'zlib', 'bz2', 'lzma' (when available) or None to
+        disable compression
+        @type codec: str
+        @param level: compression level, 1 (fast) to 9 (small)
+        @type level: int
+        @param threshold: minimum message size to compress, in bytes
+        @type threshold: int
+        @param bandwidth: link speed in bytes per second, None to always
+        compress
+        @type bandwidth: None or float
+        @rtype: None
+        """
+        import Pyro.protocol
+        policy=None
+        if codec is not None:
+            policy=Pyro.protocol.CompressionPolicy(codec, level, threshold,
+                                                   bandwidth=bandwidth)
+        self.py._setCompression(policy)
+
+    def compressionStats(self):
+        """
+        Returns the compression stats of the connection(s) to this
+        PythonEngine: messages seen, compressed and skipped (small,
+        incompressible or unprofitable), bytes before compression, bytes
+        saved and the CPU seconds spent compressing and decompressing.
+        
+        @rtype: dict
+        """
+        return self.py._getCompressionStats()
+
     def benchmark(self, cycles=10):
         """Benchmarks remote engine.
         
@@ -489,7 +1032,10 @@ class PythonEngine:
         return nettime, proctime, self.isBusy()
         
     def __repr__(self):
-        return "<PythonEngine %s on %s>" % self.info['PythonEngine ID']
+        if self.session is None:
+            return "<PythonEngine %s on %s>" % self.info['PythonEngine ID']
+        return "<PythonEngine %s on %s, session %s>" % (
+            self.info['PythonEngine ID'] + (self.session,))
     
     def __str__(self):
         info="PythonEngine %s on %s\n" % self.info['PythonEngine ID']
@@ -498,6 +1044,108 @@ class PythonEngine:
         return info
 
         
+class Stream:
+    """
+    Iterator over the chunks of a variable returned by
+    L{PythonEngine.get_stream}. 'kind' is 'array', 'str' or 'pickle', for
+    arrays 'dtype' and 'shape' describe the whole array, otherwise 'size'
+    is its length in bytes.
+    """
+    
+    def __init__(self, pyeng, handle, kind, info):
+        self.pyeng=pyeng
+        self.handle=handle
+        self.kind=kind
+        self.dtype=self.shape=self.size=None
+        if kind=='array': self.dtype, self.shape = info
+        else: self.size=info
+        self.closed=False
+    
+    def __iter__(self):
+        return self
+    
+    def next(self):
+        if self.closed: raise StopIteration
+        chunk=self.pyeng.py.stream_read(self.handle)
+        if chunk is None:
+            self.closed=True
+            raise StopIteration
+        return chunk
+    
+    def close(self):
+        """
+        Discards the rest of the stream on the Python side.
+        
+        @rtype: None
+        """
+        if not self.closed:
+            self.closed=True
+            self.pyeng.py.stream_close(self.handle)
+    
+    def __del__(self):
+        try: self.close()
+        except: pass
+
+class Batch:
+    """
+    Calls to a remote PythonEngine recorded to be pipelined together, see
+    L{PythonEngine.batch}. Methods are the ones of the server-side engine
+    (set, get, getmany, eval, exe, call, ...), the ones that take a
+    session run on the session of the PythonEngine that created the batch.
+    """
+
+    # names of the server methods with a 'session' argument
+    _session_methods_=None
+
+    def __init__(self, pyeng):
+        if Batch._session_methods_ is None:
+            Batch._session_methods_=_sessionMethods()
+        self.pyeng=pyeng
+        self.calls=[]
+
+    def __getattr__(self, name):
+        if name.startswith('_'): raise AttributeError, name
+        def record(*args, **kwds):
+            if name in self._session_methods_ and 'session' not in kwds:
+                kwds['session']=self.pyeng.session
+            self.calls.append((name, args, kwds))
+        return record
+
+    def __len__(self):
+        return len(self.calls)
+
+    def run(self, raiseErrors=True):
+        """
+        Pipelines the recorded calls and returns their results in order.
+        The batch is emptied, so it can be reused.
+        
+        @param raiseErrors: if True the first call that failed raises its
+        exception (after all the calls ran), otherwise failed calls leave
+        their exception in the results
+        @type raiseErrors: bool
+        @rtype: list
+        """
+        import Pyro.util
+        import Pyro.errors
+        calls, self.calls = self.calls, []
+        try:
+            results=self.pyeng.py._pipeline(calls)
+        except Exception, x:
+            print ''.join(Pyro.util.getPyroTraceback(x))
+            raise
+        for i, result in enumerate(results):
+            if isinstance(result, Pyro.errors.PyroExceptionCapsule):
+                if raiseErrors:
+                    try: result.raiseEx()
+                    except Exception, x:
+                        print ''.join(Pyro.util.getPyroTraceback(x))
+                        raise
+                results[i]=result.excObj
+            elif calls[i][0] in ('set', 'setmany', 'exe', 'install',
+                                 'clear'):
+                self.pyeng._seenVersion(result)
+        return results
+
 class EngBox:
     "A class that manages and helps to deal with several PythonEngine(s)"
 
@@ -520,10 +1168,12 @@ class EngBox:
         @type pyengs: list
         @rtype: list of strs
         """
-        import thread, srpydynamic
+        import thread, srpydynamic, srpyscheduler
         self._engines_=pyengs
         self.mrp = srpydynamic.MultiRunParallel(self)
         self.mrs = srpydynamic.MultiRunSequential(self)
+        self.scheduler = srpyscheduler.Scheduler(self)
+        self.registry = srpyscheduler.DataRegistry()
                     
     def append(self, pyeng):
         """
@@ -540,6 +1190,7 @@ class EngBox:
         @rtype: None
         """
         self._engines_.append(pyeng)
+        self.scheduler.reindex()
         
     def startAndAppend(self, uri):
         """
@@ -600,32 +1251,20 @@ class EngBox:
         
     def searchForEngine(self, name='', group='', ip='', hostname=''):
         """
-        Search for PythonEngine(s) with given name, group, ip or hostname.
+        Search for PythonEngine(s) with given name, group, ip or hostname,
+        using the index of the L{Scheduler <srpyscheduler.Scheduler>}.
                 
         @return: found PythonEngine(s)
         @rtype: EngBox
         """
-        pyengs=[]
-        for pyeng in self:
-            if name=='': nfound=1
-            else: nfound=0
-            if group=='': gfound=1
-            else: gfound=0
-            if ip=='': ipfound=1
-            else: ipfound=0
-            if hostname=='': hfound=1
-            else: hfound=0
-            if name==pyeng.name: nfound=1
-            if group==pyeng.group: gfound=1
-            if ip==pyeng.ip: ipfound=1
-            if hostname==pyeng.hostname: hfound=1
-            if nfound and gfound and ipfound and hfound:
-                pyengs.append(pyeng)
-        return EngBox(pyengs)
+        return EngBox(self.scheduler.lookup(name, group, ip, hostname))
         
     def getFastest(self, single=True, basis='all', *args, **kwds):
         """
-        Returns the fastest PythonEngine based on benchmarks
+        Returns the fastest PythonEngine based on benchmarks, the results
+        are reused for the 'ttl' seconds of the
+        L{Scheduler <srpyscheduler.Scheduler>}, pass refresh=True to run
+        the benchmarks again
         
         Example:
         
@@ -651,40 +1290,340 @@ class EngBox:
         @rtype: PythonEngine or EngBox
         """
         from operator import itemgetter
-        bench = self.mrpwait(self.mrp.benchmark(*args, **kwds))
+        from srpyerror import SRPyServerNotFound
+        refresh = kwds.pop('refresh', False)
+        bench = self.scheduler.benchmark(refresh, *args, **kwds)
         pyengs={}
         for pyeng in bench:
             if basis=='net': pyengs[pyeng]=bench[pyeng][0]
             elif basis=='proc': pyengs[pyeng]=bench[pyeng][1]
             else: pyengs[pyeng]=bench[pyeng][0]+bench[pyeng][1]
         fastest = [x[0] for x in sorted(pyengs.items(), key=itemgetter(1))]
+        if not fastest: raise SRPyServerNotFound, "no engine answered the benchmark"
         if single==True: return fastest[0]
         return EngBox(fastest)
         
-    def getDead(self, new=False):
+    def getDead(self, new=False, timeout=5):
         """
-        Returns indexes of dead PythonEngine(s)
+        Returns indexes of dead PythonEngine(s), all the PythonEngine(s) are
+        pinged at once (see L{PythonEngine.heartbeat}) and the ones that do
+        not answer within timeout are dead.
         
         @param new: if not False, returns a new EngBox with the PythonEngine(s)
         @type new: bool
+        @param timeout: seconds to wait for the answers
+        @type timeout: float
         @rtype: list of ints or EngBox
         """
         dead=[]
-        for n in range(len(self)):
-            try: self[n].ping()
-            except: dead.append(n)
+        for n, result in enumerate(_heartbeats(self.toList(), timeout)):
+            if isinstance(result, Exception): dead.append(n)
         if new==False: return dead
         else: return EngBox(self[dead].toList())
 
-    def cleanDead(self):
+    def cleanDead(self, timeout=5):
         """
         Removes dead PythonEngine(s) from internal list
         
+        @param timeout: seconds to wait for the answers, see L{getDead}
+        @type timeout: float
         @rtype: None
         """
-        dead=self.getDead()
-        for n in dead: del self[n]
+        dead=self.getDead(timeout=timeout)
+        # from the end, so the indexes still to delete do not move
+        for n in reversed(dead): del self[n]
+        
+    def set(self, pyeng=None, **vars):
+        """
+        Creates variables on one PythonEngine of the EngBox, the best one
+        according to the L{Scheduler <srpyscheduler.Scheduler>} unless pyeng
+        is given, and records where they are in the
+        L{DataRegistry <srpyscheduler.DataRegistry>}, so L{dispatch} can run
+        the work that uses them on that engine.
+        
+        Example:
+        
+        >>> import srpy, numpy
+        >>> engbox = srpy.newEngBox(4)
+        >>> pyeng = engbox.set(a=numpy.arange(10**6))
+        >>> engbox.locate('a')[0] is pyeng
+        True
+        
+        @param pyeng: engine to set the variables on
+        @type pyeng: L{PythonEngine}
+        @param vars: the variables to be transfered
+        @type vars: kwd dict
+        @return: the engine holding the variables
+        @rtype: L{PythonEngine}
+        """
+        from srpyscheduler import _sizeof
+        if pyeng is None: pyeng=self.scheduler.select()
+        pyeng.set(**vars)
+        for name, value in vars.items():
+            # other engines hold an older value, if any
+            self.registry.remove(name)
+            self.registry.add(name, pyeng, _sizeof(value))
+        return pyeng
+
+    def broadcast(self, name, value, fanout=2):
+        """
+        Sets a variable on every PythonEngine of the EngBox. The value is
+        sent once, to the first engine, and the engines forward it to each
+        other as a tree, each one to fanout others (see the 'relay' method
+        of L{srpyserver.PythonEngine}), so the time grows with the log of
+        the number of engines instead of linearly as with C{mrp.set}. With
+        fanout 1 the engines form a pipeline. The engines that got the
+        variable are recorded in the L{DataRegistry <srpyscheduler.DataRegistry>}
+        as its only holders.
+        
+        Example:
+        
+        >>> import srpy, numpy
+        >>> engbox = srpy.newEngBox(8)
+        >>> engbox.broadcast('a', numpy.arange(10**7))
+        []
+        
+        @param name: variable name
+        @type name: str
+        @param value: variable value
+        @type value: any
+        @param fanout: number of engines each engine forwards the value to
+        @type fanout: int
+        @return: PythonEngine(s) the variable could not be set on
+        @rtype: list
+        """
+        import Pyro.util
+        from srpyscheduler import _sizeof
+        pyengs=self.toList()[:]
+        if not pyengs: return []
+        root=pyengs[0]
+        targets=[(str(pyeng.uri), pyeng.session) for pyeng in pyengs[1:]]
+        try: version, reached, failed = root.py.relay(
+            name, value, targets, fanout, session=root.session)
+        except Exception, x:
+            print ''.join(Pyro.util.getPyroTraceback(x)) 
+            raise
+        # sessions on the same server share its uri
+        versions=dict([(tuple(target), v) for target, v in reached])
+        versions[(str(root.uri), root.session)]=version
+        size=_sizeof(value)
+        missed=[]
+        self.registry.remove(name)
+        for pyeng in pyengs:
+            target=(str(pyeng.uri), pyeng.session)
+            if target in versions:
+                pyeng._seenVersion(versions[target])
+                self.registry.add(name, pyeng, size)
+            else: missed.append(pyeng)
+        return missed
+
+    def locate(self, name):
+        """
+        Returns the PythonEngine(s) of the EngBox holding a variable set
+        with L{set}.
+        
+        @param name: variable name
+        @type name: str
+        @rtype: L{EngBox}
+        """
+        holders=self.registry.holders(name)
+        return EngBox([pyeng for pyeng in self if pyeng in holders])
+
+    def dispatch(self, names, method, *args, **kwds):
+        """
+        Runs a PythonEngine method asynchronously where the variables names
+        are, see L{set}. The engine is chosen by the
+        L{Scheduler <srpyscheduler.Scheduler>}: an engine holding all the
+        variables unless they are all much busier than the others. The
+        variables the chosen engine lacks are copied from a holder first
+        (see L{PythonEngine.copy_to}) and recorded, so later work on them
+        can go to either engine.
+        
+        Example:
+        
+        >>> import srpy, numpy
+        >>> engbox = srpy.newEngBox(4)
+        >>> pyeng = engbox.set(a=numpy.arange(10**6))
+        >>> future = engbox.dispatch(['a'], 'eval', 'a.sum()')
+        >>> future.result()
+        499999500000
+        
+        @param names: names of the variables the work uses
+        @type names: list of strs
+        @param method: name of the method, eg: 'eval' or 'vexe'
+        @type method: str
+        @rtype: L{Future <srpyfuture.Future>}
+        """
+        pyeng=self.scheduler.select(data=names)
+        # missing variables grouped by the holder they are copied from
+        copies={}
+        for name in names:
+            holders=self.registry.holders(name)
+            if not holders or pyeng in holders: continue
+            sources=[holder for holder in self if holder in holders]
+            if not sources: continue
+            sources.sort(key=lambda holder: holder.hostname!=pyeng.hostname)
+            copies.setdefault(sources[0], []).append((name, holders[sources[0]]))
+        for source, copied in copies.items():
+            source.copy_to(pyeng, [name for name, size in copied])
+            for name, size in copied: self.registry.add(name, pyeng, size)
+        return pyeng._submit(getattr(pyeng, method), *args, **kwds)
+
+    def map(self, func_name, iterable, chunksize=None):
+        """
+        Applies a remote function to every item of iterable, spreading the
+        items between the PythonEngine(s) of the EngBox, returns the
+        results in order.
+        
+        Example:
+        
+        >>> import srpy
+        >>> uri1, proc1 = srpy.newSubEngine()
+        >>> uri2, proc2 = srpy.newSubEngine()
+        >>> pyeng1 = srpy.PythonEngine(uri1)
+        >>> pyeng2 = srpy.PythonEngine(uri2)
+        >>> engbox = srpy.EngBox([pyeng1, pyeng2])
+        >>> engbox.map('math.sqrt', [1, 4, 9])
+        [1.0, 2.0, 3.0]
+        
+        @param func_name: name of a builtin or of a function in an importable
+        module (eg: 'math.sqrt'), see L{PythonEngine.install} to make
+        modules available on the PythonEngine(s)
+        @type func_name: str
+        @param iterable: items to be passed to the function
+        @type iterable: iterable
+        @param chunksize: number of items sent together to a PythonEngine,
+        if None it is chosen from the number of items and PythonEngine(s)
+        @type chunksize: int
+        @rtype: list
+        """
+        self._checkFarm(chunksize)
+        if chunksize is None:
+            if not hasattr(iterable, '__len__'): iterable=list(iterable)
+            chunksize, extra = divmod(len(iterable), len(self)*4)
+            if extra or not chunksize: chunksize+=1
+        return list(self.imap(func_name, iterable, chunksize))
+
+    def imap(self, func_name, iterable, chunksize=1):
+        """
+        Lazy version of L{map}, results are yielded in order as soon as they
+        are available. Idle PythonEngine(s) take the next chunk of items as
+        soon as they finish the previous one, the items are read as the
+        results are consumed, at most two chunks per PythonEngine ahead.
         
+        @param func_name: name of the function, see L{map}
+        @type func_name: str
+        @param iterable: items to be passed to the function
+        @type iterable: iterable
+        @param chunksize: number of items sent together to a PythonEngine
+        @type chunksize: int
+        @rtype: iterator
+        """
+        self._checkFarm(chunksize)
+        return self._farm(func_name, iterable, chunksize, True)
+
+    def imap_unordered(self, func_name, iterable, chunksize=1):
+        """
+        Same as L{imap} but results are yielded in the order in which the
+        PythonEngine(s) return them.
+        
+        @param func_name: name of the function, see L{map}
+        @type func_name: str
+        @param iterable: items to be passed to the function
+        @type iterable: iterable
+        @param chunksize: number of items sent together to a PythonEngine
+        @type chunksize: int
+        @rtype: iterator
+        """
+        self._checkFarm(chunksize)
+        return self._farm(func_name, iterable, chunksize, False)
+
+    def _checkFarm(self, chunksize):
+        # _farm is a generator, its caller validates before the first item
+        if len(self)==0: raise ValueError, "EngBox has no PythonEngine(s)"
+        if chunksize is not None and chunksize<1:
+            raise ValueError, "chunksize must be at least 1"
+
+    def _farm(self, func_name, iterable, chunksize, ordered):
+        import threading, Queue, itertools, srpyfuture
+        module=func_name.rpartition('.')[0]
+        code='__results__ = map(%s, __chunk__)' % func_name
+        if module: code='import %s\n%s' % (module, code)
+        def chunker():
+            items=iter(iterable)
+            for index in itertools.count():
+                chunk=list(itertools.islice(items, chunksize))
+                if not chunk: return
+                yield index, chunk
+        chunks=chunker()
+        stop=threading.Event()
+        # chunks read from the iterable and not yielded yet are limited to
+        # window, so the input is read as the results are consumed and the
+        # replies (at most one per chunk, an error and an end per engine)
+        # never fill their queue
+        window=2*len(self)
+        ahead=[0]
+        free=threading.Condition(threading.Lock())
+        replies=Queue.Queue(window+2*len(self))
+        def take():
+            free.acquire()
+            try:
+                while ahead[0]>=window and not stop.isSet(): free.wait()
+                if stop.isSet(): raise StopIteration
+                index, chunk = chunks.next()
+                ahead[0]+=1
+                return index, chunk
+            finally:
+                free.release()
+        def release():
+            free.acquire()
+            ahead[0]-=1
+            free.notifyAll()
+            free.release()
+        def work(pyeng):
+            try:
+                while 1:
+                    try: index, chunk = take()
+                    except StopIteration: return
+                    results=pyeng.vexe(code, get=['__results__'],
+                                       __chunk__=chunk)['__results__']
+                    replies.put((index, results, None))
+            except Exception, error:
+                stop.set()
+                replies.put((None, None, error))
+            finally:
+                replies.put(None)
+        # a thread per PythonEngine for the whole run, kept off the shared
+        # pool so the '_async' methods and mrp don't wait behind it
+        pool=srpyfuture.WorkerPool(len(self))
+        for pyeng in self: pyeng._submitTo(pool, work, pyeng)
+        pool.shutdown(wait=False)
+        running=len(self)
+        nextindex=0
+        pending={}
+        try:
+            while running:
+                reply=replies.get()
+                if reply is None:
+                    running-=1
+                    continue
+                index, results, error = reply
+                if error is not None: raise error
+                if not ordered:
+                    release()
+                    for result in results: yield result
+                    continue
+                pending[index]=results
+                while nextindex in pending:
+                    release()
+                    for result in pending.pop(nextindex): yield result
+                    nextindex+=1
+        finally:
+            free.acquire()
+            stop.set()
+            free.notifyAll()
+            free.release()
+
     def mrs(self):
         """
         mrs - Multi-Run in Sequence
@@ -729,18 +1668,22 @@ class EngBox:
         >>> pyeng2 = srpy.PythonEngine(uri2)
         >>> engbox = srpy.EngBox([pyeng1, pyeng2])
         >>> res = engbox.mrp.benchmark(); res.values()
-        ['__null__', '__null__']
+        []
+        >>> for pyeng, bench in res.as_completed(): print pyeng, bench
         
         @returns: sequence of PythonEngine reference: method return values,
-        return values are by default '__null__' until the thread finishes.
-        See method 'mrpwait' for ways to wait for threads to finish.
-        @rtype: dict
+        each PythonEngine is only present once its call finishes.
+        See method 'mrpwait' and the result C{wait}, C{done}, C{pending} and
+        C{as_completed} methods for ways to wait for the calls to finish.
+        The calls run on threads of their own, one per PythonEngine.
+        @rtype: L{MultiRunResult <srpydynamic.MultiRunResult>}
         """
         pass    
         
     def mrpwait(self, mrp_result, timeout=-1, sleeptime=0.01):
         """
-        Waits for all the threads in a 'mrp' job to finish.
+        Waits for all the calls in a 'mrp' job to finish, returns as soon as
+        the last PythonEngine replies.
         
         Example:
         
@@ -755,19 +1698,14 @@ class EngBox:
         @param timeout: maximum amount of time to wait for 'mrp' job to finish,
         if -1 will wait forever.
         @type timeout: number
-        @param sleeptime: how offen in seconds the function checks to see if
-        'mrp' job has finished, if this value is too low will create high
-        processor overhead, on the other side, if the value is too high it
-        may cause delays in the return
+        @param sleeptime: unused, kept for backwards compatibility
         @type sleeptime: number
-        @rtype: None        
+        @return: the given 'mrp' job result
+        @rtype: L{MultiRunResult <srpydynamic.MultiRunResult>}
         """
-        import time
-        start=time.time()
-        while 1:
-            if mrp_result.values().count('__null__') == 0: return mrp_result
-            elif timeout!=-1 and (time.time()-start)>timeout: return mrp_result
-            time.sleep(sleeptime)
+        if timeout==-1: timeout=None
+        mrp_result.wait(timeout)
+        return mrp_result
             
     def __str__(self):
         return repr(self._engines_)
@@ -789,12 +1727,66 @@ class EngBox:
         else:
             return EngBox(self._engines_[key])
 
+    def __setitem__(self, key, pyeng):
+        self._forget(key)
+        self._engines_[key]=pyeng
+        self.scheduler.reindex()
+
     def __delitem__(self, key):
+        self._forget(key)
         del self._engines_[key]
+        self.scheduler.reindex()
+
+    def _forget(self, key):
+        # the data of engines leaving the EngBox is no longer reachable
+        removed=self._engines_[key]
+        if type(key)==type(0): removed=[removed]
+        for pyeng in removed: self.registry.removeEngine(pyeng)
 
     def __iter__(self):
         return self._engines_.__iter__()
 
+def _sessionMethods():
+    "Returns the names of the server-side methods with a 'session' keyword"
+    import inspect
+    try: import srpyserver
+    except ImportError: from srpy import srpyserver
+    names=[]
+    for name, member in vars(srpyserver.PythonEngine).items():
+        func=getattr(member, 'f', member)
+        if name.startswith('_') or not inspect.isfunction(func): continue
+        args, varargs, varkw, defaults = inspect.getargspec(func)
+        if 'session' in args[len(args)-len(defaults or ()):]:
+            names.append(name)
+    return frozenset(names)
+
+def _heartbeats(pyengs, timeout):
+    """
+    Calls L{PythonEngine.heartbeat} on every PythonEngine at once, returns
+    for each one the round trip time in seconds or the exception raised,
+    PythonEngine(s) that miss the deadline get a SRPyTimeout.
+    """
+    import threading, time
+    from srpyerror import SRPyTimeout
+    results=[None]*len(pyengs)
+    def beat(n):
+        try: results[n]=pyengs[n].heartbeat(timeout)
+        except Exception, x: results[n]=x
+    threads=[threading.Thread(target=beat, args=(n,))
+             for n in range(len(pyengs))]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    deadline=time.time()+timeout
+    for thread in threads: thread.join(max(0, deadline-time.time()))
+    # late answers must not change the returned list
+    results=list(results)
+    for n in range(len(pyengs)):
+        if results[n] is None:
+            results[n]=SRPyTimeout("%s missed the %ss heartbeat" % (
+                pyengs[n].uri, timeout))
+    return results
+
 if __name__=='__main__':
     import doctest
     print "Auto-testing module"
@@ -24,6 +24,9 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
 # THE POSSIBILITY OF SUCH DAMAGE.
 
+import threading, time
+from srpyerror import SRPyLockTimeout
+
 class BaseDecorator:
 	def __init__(self, f):
 		self.f=f
@@ -52,18 +55,102 @@ class BaseDecorator:
 		print "%s command took %.2fs to execute" % (self.__name__,
 							    stopTime-startTime)
 
-class ThreadSafeDecorator(BaseDecorator):	
+class ThreadSafeDecorator(BaseDecorator):
+	"""Runs the method holding the engine lock exclusively, the lock of the
+	session given by the 'session' keyword is used"""
+	_exclusive_=True
+	
 	def __call__(self, *args, **kwds):
 		fself=self.fself
-		fself._lock_.wait(fself._lock_timeout_)
+		lock=fself._session_(kwds.get('session'))[1]
+		if not lock.acquire(self._exclusive_, fself._lock_timeout_):
+			raise SRPyLockTimeout("%s could not lock the engine in %ss" % (
+				self.__name__, fself._lock_timeout_))
 		try:
-			fself._lock_.clear()
-			v = BaseDecorator.__call__(self, *args, **kwds)
-			return v
-		except:
-			raise
+			return BaseDecorator.__call__(self, *args, **kwds)
 		finally:
-			fself._lock_.set()
+			lock.release()
+
+class ReadLockDecorator(ThreadSafeDecorator):
+	"Runs the method holding the engine lock shared with other readers"
+	_exclusive_=False
+
+class _LockRequest:
+	def __init__(self, exclusive):
+		self.exclusive=exclusive
+
+class ReadWriteLock:
+	"""Fair reader/writer lock: requests are granted in arrival order,
+	consecutive shared requests are granted together"""
+	def __init__(self):
+		self._cond=threading.Condition(threading.Lock())
+		self._readers=0
+		self._writer=False
+		self._queue=[]
+	
+	def acquire(self, exclusive=True, timeout=None):
+		"Returns False if the lock could not be acquired within timeout"
+		request=_LockRequest(exclusive)
+		self._cond.acquire()
+		try:
+			self._queue.append(request)
+			if timeout is not None: deadline=time.time()+timeout
+			while not self._grantable(request):
+				if timeout is None: self._cond.wait()
+				else:
+					remaining=deadline-time.time()
+					if remaining<=0:
+						self._dequeue(request)
+						self._cond.notifyAll()
+						return False
+					self._cond.wait(remaining)
+			self._dequeue(request)
+			if exclusive: self._writer=True
+			else: self._readers+=1
+			return True
+		finally:
+			self._cond.release()
+	
+	def release(self):
+		self._cond.acquire()
+		try:
+			if self._writer: self._writer=False
+			else: self._readers-=1
+			self._cond.notifyAll()
+		finally:
+			self._cond.release()
+	
+	def isLocked(self):
+		return self._writer or self._readers>0
+	
+	def waitIdle(self, timeout=None):
+		"Waits until the lock is neither held nor requested"
+		self._cond.acquire()
+		try:
+			if timeout is not None: deadline=time.time()+timeout
+			while self.isLocked() or self._queue:
+				if timeout is None: self._cond.wait()
+				else:
+					remaining=deadline-time.time()
+					if remaining<=0: return False
+					self._cond.wait(remaining)
+			return True
+		finally:
+			self._cond.release()
+	
+	def _grantable(self, request):
+		if self._writer: return False
+		if request.exclusive:
+			return self._readers==0 and self._queue[0] is request
+		for queued in self._queue:
+			if queued is request: return True
+			if queued.exclusive: return False
+	
+	def _dequeue(self, request):
+		for n in range(len(self._queue)):
+			if self._queue[n] is request:
+				del self._queue[n]
+				return
 
 def timeString():
     t=time.localtime()[:6]
@@ -38,15 +38,26 @@ class NameSpace:
         if attr in ['bogu5_123_aTTri8ute', '_getAttributeNames']:
             raise AttributeError
         attr=self.__dict__['__root__']+attr
+        pyeng=self.__dict__['__pyeng__']
+        # modules and callables are described once per namespace version,
+        # and again after _nsttl_ seconds to see changes made by others
+        import time
+        cached=pyeng._nscache_.get(attr)
+        if cached is not None and cached[2]==pyeng._nsversion_ and \
+           time.time()-cached[3]<pyeng._nsttl_:
+            kind, doc = cached[:2]
+        else:
+            kind, doc, value, version = pyeng.py.introspect(attr,
+                                                            session=pyeng.session)
+            pyeng._seenVersion(version)
+            if kind=='missing': raise AttributeError, attr
+            # if it's a var
+            if kind=='value': return value
+            pyeng._nscache_[attr]=(kind, doc, version, time.time())
         # if it's a module
-        if self.__dict__['__pyeng__'].py.isModuleInstance(attr):
-            return NameSpace(self.__dict__['__pyeng__'], attr)
+        if kind=='module': return NameSpace(pyeng, attr)
         # if it's a callable object
-        elif self.__dict__['__pyeng__'].eval("hasattr(%s, '__call__')" % attr):
-            return self.__dict__['__pyeng__'].associateFunction(attr)
-        # if it's a var
-        else:        
-            return self.__dict__['__pyeng__'].get(attr)
+        return pyeng._remoteFunction(attr, doc)
         
     def __setattr__(self, attr, value):
         attr=self.__dict__['__root__']+attr
@@ -98,15 +109,95 @@ class MultiRunSequential(MultiRun):
 
 class MultiRunParallel(MultiRun):    
     def __run__(self, methodname, *args, **kwds):
-        import threading
+        import srpyfuture
         engbox = self.__dict__['__engbox__']
-        results = {}
-        # define threaded function
-        def f(pyeng, methodname):
-            try: results[pyeng] = getattr(pyeng, methodname)(*args, **kwds)
-            except Exception, error: results[pyeng] = error
-        # start loop
+        # a thread per PythonEngine, so every engine is called at once and
+        # the shared pool of the '_async' methods is left alone
+        pool = srpyfuture.WorkerPool(len(engbox))
+        futures = {}
         for pyeng in engbox:
-            results[pyeng] = '__null__'
-            threading.Thread(target=f, args=(pyeng, methodname)).start()
-        return results
+            method = getattr(pyeng, methodname)
+            futures[pyeng] = pyeng._submitTo(pool, method, *args, **kwds)
+        # the threads exit once the calls are done
+        pool.shutdown(wait=False)
+        return MultiRunResult(futures)
+
+class MultiRunResult(dict):
+    """
+    Results of a MultiRunParallel job, a dictionary of PythonEngine
+    reference: method return value that is filled as each PythonEngine
+    replies. If an error ocurs, it will be present as the return value.
+    """
+
+    def __init__(self, futures):
+        import threading
+        dict.__init__(self)
+        self.futures = futures
+        self._cond = threading.Condition(threading.Lock())
+        self._completed = []
+        for pyeng, future in futures.items():
+            future.add_done_callback(lambda f, pyeng=pyeng: self._done(pyeng, f))
+
+    def _done(self, pyeng, future):
+        from srpyerror import SRPyCancelled
+        if future.cancelled(): value = SRPyCancelled(pyeng)
+        else:
+            error = future.exception()
+            if error is None: value = future.result()
+            else: value = error
+        self._cond.acquire()
+        try:
+            self[pyeng] = value
+            self._completed.append(pyeng)
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def done(self):
+        "Returns True if every PythonEngine has replied"
+        return len(self._completed) == len(self.futures)
+
+    def pending(self):
+        "Returns the PythonEngine(s) that did not reply yet"
+        return [pyeng for pyeng in self.futures if pyeng not in self]
+
+    def wait(self, timeout=None):
+        """Waits until every PythonEngine has replied or timeout seconds
+        have passed, returns True if every PythonEngine has replied"""
+        import time
+        self._cond.acquire()
+        try:
+            if timeout is not None: deadline = time.time() + timeout
+            while not self.done():
+                if timeout is None: self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0: break
+                    self._cond.wait(remaining)
+            return self.done()
+        finally:
+            self._cond.release()
+
+    def as_completed(self, timeout=None):
+        """Yields (PythonEngine, return value) pairs in the order in which
+        the PythonEngine(s) reply, raises SRPyTimeout if not all of them
+        replied within timeout seconds"""
+        import time
+        from srpyerror import SRPyTimeout
+        if timeout is not None: deadline = time.time() + timeout
+        n = 0
+        while n < len(self.futures):
+            self._cond.acquire()
+            try:
+                while n == len(self._completed):
+                    if timeout is None: self._cond.wait()
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0: raise SRPyTimeout, timeout
+                        self._cond.wait(remaining)
+                pyeng = self._completed[n]
+                value = self[pyeng]
+            finally:
+                self._cond.release()
+            n += 1
+            yield pyeng, value
@@ -29,3 +29,24 @@ class SRPyServerNotFound(Exception):
         self.value = value
     def __str__(self):
         return repr(self.value)
+
+class SRPyTimeout(Exception):
+    def __init__(self, value):
+        Exception.__init__(self, value)
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+
+class SRPyCancelled(Exception):
+    def __init__(self, value):
+        Exception.__init__(self, value)
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+
+class SRPyLockTimeout(Exception):
+    def __init__(self, value):
+        Exception.__init__(self, value)
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
@@ -0,0 +1,287 @@
+# Simple Remote Python: http://code.google.com/p/srpy/
+# Copyright (c) 2009, Ricardo Henriques
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the author nor the names of its contributors
+#      may be used to endorse or promote products derived from this software
+#      without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+# THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Futures and a reusable worker pool for asynchronous PythonEngine calls
+"""
+
+__docformat__="epytext"
+
+import sys, threading, Queue
+
+class Future:
+    """
+    Result of a call running in a L{WorkerPool}.
+    """
+
+    def __init__(self):
+        self._cond=threading.Condition(threading.Lock())
+        self._state='pending'
+        self._result=None
+        self._exception=None
+        self._callbacks=[]
+
+    def cancel(self):
+        """
+        Cancels the call if it has not started yet.
+
+        @return: True if the call was cancelled
+        @rtype: bool
+        """
+        self._cond.acquire()
+        try:
+            if self._state=='pending': self._state='cancelled'
+            elif self._state!='cancelled': return False
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        self._runCallbacks()
+        return True
+
+    def cancelled(self):
+        """
+        @rtype: bool
+        """
+        return self._state=='cancelled'
+
+    def running(self):
+        """
+        @rtype: bool
+        """
+        return self._state=='running'
+
+    def done(self):
+        """
+        Returns True if the call finished or was cancelled.
+
+        @rtype: bool
+        """
+        return self._state in ('finished', 'cancelled')
+
+    def wait(self, timeout=None):
+        """
+        Waits for the call to finish.
+
+        @param timeout: maximum amount of time to wait in seconds,
+        if None will wait forever
+        @type timeout: number
+        @return: True if the call is done
+        @rtype: bool
+        """
+        import time
+        self._cond.acquire()
+        try:
+            if timeout is None:
+                while not self.done(): self._cond.wait()
+            else:
+                deadline=time.time()+timeout
+                while not self.done():
+                    remaining=deadline-time.time()
+                    if remaining<=0: break
+                    self._cond.wait(remaining)
+            return self.done()
+        finally:
+            self._cond.release()
+
+    def result(self, timeout=None):
+        """
+        Returns the value returned by the call, raising its exception if
+        the call failed.
+
+        @param timeout: maximum amount of time to wait in seconds,
+        if None will wait forever
+        @type timeout: number
+        @raise SRPyTimeout: if the call did not finish in time
+        @raise SRPyCancelled: if the call was cancelled
+        @rtype: any
+        """
+        self._check(timeout)
+        if self._exception is not None: raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """
+        Returns the exception raised by the call or None if it succeeded.
+
+        @param timeout: maximum amount of time to wait in seconds,
+        if None will wait forever
+        @type timeout: number
+        @raise SRPyTimeout: if the call did not finish in time
+        @raise SRPyCancelled: if the call was cancelled
+        @rtype: Exception or None
+        """
+        self._check(timeout)
+        return self._exception
+
+    def add_done_callback(self, fn):
+        """
+        Calls C{fn(future)} once the call is done, immediately if it is
+        already done.
+
+        @param fn: callback function
+        @type fn: function
+        @rtype: None
+        """
+        self._cond.acquire()
+        try:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        finally:
+            self._cond.release()
+        fn(self)
+
+    def _check(self, timeout):
+        from srpyerror import SRPyTimeout, SRPyCancelled
+        if not self.wait(timeout): raise SRPyTimeout, timeout
+        if self._state=='cancelled': raise SRPyCancelled, self
+
+    def _start(self):
+        self._cond.acquire()
+        try:
+            if self._state!='pending': return False
+            self._state='running'
+            return True
+        finally:
+            self._cond.release()
+
+    def _finish(self, result=None, exception=None):
+        self._cond.acquire()
+        try:
+            self._result=result
+            self._exception=exception
+            self._state='finished'
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        self._runCallbacks()
+
+    def _runCallbacks(self):
+        callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try: fn(self)
+            except Exception: pass
+
+    def __repr__(self):
+        return "<Future %s>" % self._state
+
+
+class WorkerPool:
+    """
+    A bounded pool of reusable threads that runs calls and returns
+    L{Future}(s). Threads are only started when no idle thread is available
+    and are kept alive to serve the following calls.
+    """
+
+    def __init__(self, maxworkers=32):
+        """
+        @param maxworkers: maximum number of threads in the pool
+        @type maxworkers: int
+        """
+        self.maxworkers=maxworkers
+        self._queue=Queue.Queue()
+        self._lock=threading.Lock()
+        self._workers=[]
+        self._idle=0
+
+    def submit(self, func, *args, **kwds):
+        """
+        Schedules C{func(*args, **kwds)} to run in the pool.
+
+        @return: the future result of the call
+        @rtype: L{Future}
+        """
+        future=Future()
+        self._lock.acquire()
+        try:
+            self._queue.put((future, func, args, kwds))
+            if self._queue.qsize()>self._idle and \
+               len(self._workers)<self.maxworkers:
+                worker=threading.Thread(target=self._work)
+                worker.setDaemon(True)
+                self._workers.append(worker)
+                worker.start()
+        finally:
+            self._lock.release()
+        return future
+
+    def shutdown(self, wait=True):
+        """
+        Stops the pool threads once the pending calls are done.
+
+        @param wait: if True, waits for the threads to exit
+        @type wait: bool
+        @rtype: None
+        """
+        self._lock.acquire()
+        try:
+            workers=self._workers[:]
+            for worker in workers: self._queue.put(None)
+        finally:
+            self._lock.release()
+        if wait:
+            for worker in workers: worker.join()
+
+    def _work(self):
+        while 1:
+            self._lock.acquire()
+            self._idle+=1
+            self._lock.release()
+            task=self._queue.get()
+            self._lock.acquire()
+            self._idle-=1
+            if task is None:
+                self._workers.remove(threading.currentThread())
+                self._lock.release()
+                return
+            self._lock.release()
+            future, func, args, kwds = task
+            if not future._start(): continue
+            try: result=func(*args, **kwds)
+            except Exception, error: future._finish(exception=error)
+            else: future._finish(result)
+
+    def __len__(self):
+        return len(self._workers)
+
+
+_defaultPool=None
+_defaultPoolLock=threading.Lock()
+
+def getDefaultPool():
+    """
+    Returns the L{WorkerPool} shared by all PythonEngine(s) that were not
+    given a pool of their own.
+
+    @rtype: L{WorkerPool}
+    """
+    global _defaultPool
+    _defaultPoolLock.acquire()
+    try:
+        if _defaultPool is None: _defaultPool=WorkerPool()
+        return _defaultPool
+    finally:
+        _defaultPoolLock.release()
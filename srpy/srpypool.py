@@ -0,0 +1,167 @@
+# Simple Remote Python: http://code.google.com/p/srpy/
+# Copyright (c) 2009, Ricardo Henriques
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the author nor the names of its contributors
+#      may be used to endorse or promote products derived from this software
+#      without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+# THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Pool of Pyro connections to a single remote PythonEngine
+"""
+
+__docformat__="epytext"
+
+import threading, time, Queue
+
+class ProxyPool:
+    """
+    Stands in for a Pyro proxy, keeping up to C{size} bound connections
+    to the same URI and running each call on an idle one, so several
+    threads can use the same PythonEngine concurrently.
+    """
+
+    def __init__(self, uri, size):
+        """
+        @param uri: remote PythonEngine identifier
+        @type uri: str
+        @param size: maximum number of connections
+        @type size: int
+        """
+        if size<1: raise ValueError, "size must be at least 1"
+        self.uri=uri
+        self.size=size
+        self._idle=Queue.Queue()
+        self._proxies=[]
+        self._lock=threading.Lock()
+        self._calls=0
+        self._waits=0
+        self._waittime=0.
+        self._maxwait=0.
+        # proxy method: arguments, applied to every connection
+        self._options={}
+
+    def __getattr__(self, name):
+        if name.startswith('__'): raise AttributeError, name
+        return lambda *args, **kwds: self._invoke(name, args, kwds)
+
+    def _invoke(self, name, args, kwds):
+        proxy=self._acquire()
+        self._lock.acquire()
+        self._calls+=1
+        self._lock.release()
+        try: return getattr(proxy, name)(*args, **kwds)
+        finally: self._idle.put(proxy)
+
+    def _pipeline(self, calls):
+        "Pipelines the calls on a single idle connection"
+        proxy=self._acquire()
+        self._lock.acquire()
+        self._calls+=len(calls)
+        self._lock.release()
+        try: return proxy._pipeline(calls)
+        finally: self._idle.put(proxy)
+
+    def _acquire(self):
+        import Pyro.core
+        try: return self._idle.get_nowait()
+        except Queue.Empty: pass
+        self._lock.acquire()
+        try:
+            if len(self._proxies)<self.size:
+                proxy=Pyro.core.getProxyForURI(self.uri)
+                for method, args in self._options.items():
+                    getattr(proxy, method)(*args)
+                self._proxies.append(proxy)
+                return proxy
+        finally:
+            self._lock.release()
+        start=time.time()
+        proxy=self._idle.get()
+        waited=time.time()-start
+        self._lock.acquire()
+        self._waits+=1
+        self._waittime+=waited
+        self._maxwait=max(self._maxwait, waited)
+        self._lock.release()
+        return proxy
+
+    def _setOption(self, method, *args):
+        self._lock.acquire()
+        try:
+            self._options[method]=args
+            for proxy in self._proxies: getattr(proxy, method)(*args)
+        finally:
+            self._lock.release()
+
+    def _setSerializer(self, name):
+        "Sets the serializer used by every connection, see Pyro.protocol"
+        self._setOption('_setSerializer', name)
+
+    def _setCompression(self, policy):
+        "Sets the compression policy of every connection, see Pyro.protocol"
+        self._setOption('_setCompression', policy)
+
+    def _getCompressionStats(self):
+        "Returns the compression stats of all the connections added up"
+        import Pyro.protocol
+        total=Pyro.protocol.newCompressionStats()
+        self._lock.acquire()
+        try:
+            for proxy in self._proxies:
+                for key, value in proxy._getCompressionStats().items():
+                    total[key]+=value
+        finally:
+            self._lock.release()
+        return total
+
+    def getStats(self):
+        """
+        Returns pool usage metrics: number of connections, calls, calls that
+        had to wait for an idle connection, total and maximum wait time.
+
+        @rtype: dict
+        """
+        self._lock.acquire()
+        try:
+            return {'connections': len(self._proxies),
+                    'size': self.size,
+                    'idle': self._idle.qsize(),
+                    'calls': self._calls,
+                    'waits': self._waits,
+                    'waittime': self._waittime,
+                    'maxwait': self._maxwait}
+        finally:
+            self._lock.release()
+
+    def _release(self):
+        "Closes every idle connection"
+        while 1:
+            try: proxy=self._idle.get_nowait()
+            except Queue.Empty: break
+            self._lock.acquire()
+            self._proxies.remove(proxy)
+            self._lock.release()
+            proxy._release()
+
+    def __repr__(self):
+        return "<ProxyPool for %s, %d connections>" % (self.uri,
+                                                      len(self._proxies))
@@ -0,0 +1,326 @@
+# Simple Remote Python: http://code.google.com/p/srpy/
+# Copyright (c) 2009, Ricardo Henriques
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the author nor the names of its contributors
+#      may be used to endorse or promote products derived from this software
+#      without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+# THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Engine selection for an EngBox: cached benchmarks, host and group indexes,
+least-loaded routing and the registry of where the data lives
+"""
+
+__docformat__="epytext"
+
+import sys, threading, time
+
+def _sizeof(value):
+    "Approximate size in bytes of a value sent to an engine"
+    if hasattr(value, 'nbytes'): return value.nbytes
+    if isinstance(value, (str, unicode, buffer)): return len(value)
+    return sys.getsizeof(value)
+
+class DataRegistry:
+    """
+    Records which PythonEngine(s) hold which variables and their sizes.
+    Every EngBox has one in its 'registry' attribute, it is filled by
+    L{EngBox.set <srpyclient.EngBox.set>} and used by
+    L{EngBox.dispatch <srpyclient.EngBox.dispatch>} to run work where its
+    data already is.
+    """
+
+    def __init__(self):
+        self._lock=threading.Lock()
+        # variable name: {PythonEngine: size in bytes}
+        self._holders={}
+
+    def add(self, name, pyeng, size):
+        """
+        Records that pyeng holds the variable name.
+        
+        @rtype: None
+        """
+        self._lock.acquire()
+        try: self._holders.setdefault(name, {})[pyeng]=size
+        finally: self._lock.release()
+
+    def remove(self, name, pyeng=None):
+        """
+        Forgets the variable name on pyeng, or on every engine if pyeng is
+        None, eg: after it was deleted remotely.
+        
+        @rtype: None
+        """
+        self._lock.acquire()
+        try:
+            holders=self._holders.get(name, {})
+            if pyeng is None: holders.clear()
+            elif pyeng in holders: del holders[pyeng]
+            if not holders and name in self._holders: del self._holders[name]
+        finally:
+            self._lock.release()
+
+    def removeEngine(self, pyeng):
+        """
+        Forgets every variable held by pyeng, eg: after it died.
+        
+        @rtype: None
+        """
+        for name in self.names(pyeng): self.remove(name, pyeng)
+
+    def holders(self, name):
+        """
+        Returns the engines holding the variable name and its size on each.
+        
+        @return: PythonEngine: size in bytes
+        @rtype: dict
+        """
+        self._lock.acquire()
+        try: return dict(self._holders.get(name, {}))
+        finally: self._lock.release()
+
+    def names(self, pyeng=None):
+        """
+        Returns the registered variable names, only the ones held by pyeng
+        if given.
+        
+        @rtype: list of strs
+        """
+        self._lock.acquire()
+        try:
+            return [name for name, holders in self._holders.items()
+                    if pyeng is None or pyeng in holders]
+        finally:
+            self._lock.release()
+
+    def missing(self, pyeng, names):
+        """
+        Returns how many bytes of the variables names pyeng does not hold,
+        taking the size of each variable from any of its holders.
+        
+        @rtype: int
+        """
+        size=0
+        for name in names:
+            holders=self.holders(name)
+            if pyeng not in holders and holders:
+                size+=max(holders.values())
+        return size
+
+class Scheduler:
+    """
+    Chooses PythonEngine(s) of an EngBox to run work on. Every EngBox has
+    one in its 'scheduler' attribute. Benchmark results are cached for ttl
+    seconds and the engines are indexed by host, ip, name and group, the
+    index is rebuilt after the EngBox changes (see L{reindex}).
+    """
+
+    def __init__(self, engbox, ttl=60, remotePenalty=1):
+        """
+        @param engbox: PythonEngine(s) to choose from
+        @type engbox: L{EngBox <srpyclient.EngBox>}
+        @param ttl: seconds a benchmark result is reused
+        @type ttl: float
+        @param remotePenalty: pending calls an engine on the preferred host
+        may have over an engine on another host and still be chosen
+        @type remotePenalty: int
+        """
+        self.engbox=engbox
+        self.ttl=ttl
+        self.remotePenalty=remotePenalty
+        self._lock=threading.Lock()
+        # PythonEngine: (time, benchmark args, benchmark result)
+        self._benchmarks={}
+        # (attribute, value): list of PythonEngine(s)
+        self._index=None
+
+    def reindex(self):
+        """
+        Drops the engine index, it is rebuilt on the next lookup. EngBox
+        calls it when engines are added, replaced or removed, call it after
+        changing the name or group of an engine of the EngBox.
+        
+        @rtype: None
+        """
+        self._index=None
+
+    def lookup(self, name='', group='', ip='', hostname=''):
+        """
+        Returns the PythonEngine(s) with the given name, group, ip and
+        hostname, empty values match any engine.
+        
+        @rtype: list
+        """
+        index=self._index
+        if index is None:
+            index={}
+            for pyeng in self.engbox:
+                for key in (('name', pyeng.name), ('group', pyeng.group),
+                            ('ip', pyeng.ip), ('hostname', pyeng.hostname)):
+                    index.setdefault(key, []).append(pyeng)
+            self._index=index
+        found=None
+        for key in (('name', name), ('group', group), ('ip', ip),
+                    ('hostname', hostname)):
+            if key[1]=='': continue
+            pyengs=index.get(key, [])
+            if found is None: found=pyengs
+            else: found=[pyeng for pyeng in found if pyeng in pyengs]
+        if found is None: return self.engbox.toList()[:]
+        return found[:]
+
+    def hosts(self):
+        """
+        Returns the PythonEngine(s) grouped by hostname.
+        
+        @rtype: dict
+        """
+        self.lookup()
+        hosts={}
+        for (attribute, value), pyengs in self._index.items():
+            if attribute=='hostname': hosts[value]=pyengs[:]
+        return hosts
+
+    def benchmark(self, refresh=False, *args, **kwds):
+        """
+        Returns the L{PythonEngine.benchmark <srpyclient.PythonEngine.benchmark>}
+        result of every engine, only the engines without a result younger
+        than ttl seconds for the same arguments are benchmarked, all at once.
+        Engines whose benchmark fails are left out and benchmarked again on
+        the next call.
+        
+        @param refresh: if True, benchmarks every engine again
+        @type refresh: bool
+        @return: PythonEngine: (network time, processor time, is busy)
+        @rtype: dict
+        """
+        try: from srpyclient import EngBox
+        except ImportError: from srpy.srpyclient import EngBox
+        now=time.time()
+        key=(args, sorted(kwds.items()))
+        results={}
+        stale=[]
+        self._lock.acquire()
+        try:
+            for pyeng in self.engbox:
+                cached=self._benchmarks.get(pyeng)
+                if refresh or cached is None or cached[1]!=key or \
+                   now-cached[0]>self.ttl:
+                    stale.append(pyeng)
+                else:
+                    results[pyeng]=cached[2]
+        finally:
+            self._lock.release()
+        if stale:
+            stalebox=EngBox(stale)
+            bench=stalebox.mrpwait(stalebox.mrp.benchmark(*args, **kwds))
+            self._lock.acquire()
+            try:
+                for pyeng in stale:
+                    if isinstance(bench[pyeng], Exception): continue
+                    self._benchmarks[pyeng]=(now, key, bench[pyeng])
+                    results[pyeng]=bench[pyeng]
+                # forget engines that left the EngBox
+                for pyeng in self._benchmarks.keys():
+                    if pyeng not in results: del self._benchmarks[pyeng]
+            finally:
+                self._lock.release()
+        return results
+
+    def rank(self, host='', group='', exclude=(), data=()):
+        """
+        Returns the PythonEngine(s) of the given group sorted from the best
+        choice for new work to the worst: fewest pending calls first (see
+        L{PythonEngine.load <srpyclient.PythonEngine.load>}), engines on the
+        given host (hostname or ip) are preferred unless they have more than
+        remotePenalty pending calls over the others. In the same way engines
+        already holding the given data variables (see L{DataRegistry}) are
+        preferred, and among the others the ones missing the fewest bytes,
+        then the engines with the best health score (see L{Supervisor <srpysupervisor.Supervisor>})
+        and the fastest cached processor benchmark.
+        
+        @param host: hostname or ip to prefer, eg: where the data is
+        @type host: str
+        @param group: only engines of this group, any group if empty
+        @type group: str
+        @param exclude: engines not to choose
+        @type exclude: list
+        @param data: names of the variables the work uses
+        @type data: list of strs
+        @rtype: list
+        """
+        registry=getattr(self.engbox, 'registry', None)
+        def cost(pyeng):
+            remote=host!='' and host not in (pyeng.hostname, pyeng.ip)
+            if data and registry is not None:
+                missing=registry.missing(pyeng, data)
+            else: missing=0
+            health=getattr(pyeng, 'health', None)
+            if health is None: score=0.0
+            else: score=health.score()
+            cached=self._benchmarks.get(pyeng)
+            if cached is None: proctime=0.0
+            else: proctime=cached[2][1]
+            penalty=self.remotePenalty*(remote+(missing>0))
+            return (pyeng.load()+penalty, missing, remote, score, proctime)
+        pyengs=[pyeng for pyeng in self.lookup(group=group)
+                if pyeng not in exclude]
+        pyengs.sort(key=cost)
+        return pyengs
+
+    def select(self, host='', group='', exclude=(), data=()):
+        """
+        Returns the best PythonEngine for new work, see L{rank}.
+        
+        Example:
+        
+        >>> import srpy
+        >>> engbox = srpy.newEngBox(4)
+        >>> pyeng = engbox.scheduler.select()
+        >>> future = pyeng.apply_async('math.pow', 2, 10)
+        
+        @rtype: L{PythonEngine <srpyclient.PythonEngine>}
+        """
+        from srpyerror import SRPyServerNotFound
+        pyengs=self.rank(host, group, exclude, data)
+        if not pyengs:
+            raise SRPyServerNotFound, "no engine of group '%s'" % group
+        return pyengs[0]
+
+    def submit(self, method, *args, **kwds):
+        """
+        Runs a PythonEngine method asynchronously on the engine returned by
+        L{select}.
+        
+        Example:
+        
+        >>> import srpy
+        >>> engbox = srpy.newEngBox(4)
+        >>> futures = [engbox.scheduler.submit('eval', '%d**2' % n)
+        ...            for n in range(100)]
+        
+        @param method: name of the method, eg: 'apply' or 'vexe'
+        @type method: str
+        @rtype: L{Future <srpyfuture.Future>}
+        """
+        pyeng=self.select()
+        return pyeng._submit(getattr(pyeng, method), *args, **kwds)
@@ -24,82 +24,386 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
 # THE POSSIBILITY OF SUCH DAMAGE.
 
-import sys, os, threading, types, tempfile, random, platform
+import sys, os, threading, types, tempfile, random, platform, time
 import srpydecorators
 
+class CodeCache:
+	"Least recently used cache of compiled code objects"
+	def __init__(self, maxsize=256):
+		self.maxsize=maxsize
+		self.hits=0
+		self.misses=0
+		self._codes_={}	# (source, mode): [code, last use]
+		self._tick_=0
+		self._lock_=threading.Lock()
+	
+	def compile(self, source, mode):
+		"Same as compile(source, '<string>', mode) but cached"
+		key=(source, mode)
+		self._lock_.acquire()
+		try:
+			self._tick_+=1
+			entry=self._codes_.get(key)
+			if entry is not None:
+				self.hits+=1
+				entry[1]=self._tick_
+				return entry[0]
+			self.misses+=1
+		finally:
+			self._lock_.release()
+		code=compile(source, '<string>', mode)
+		self._lock_.acquire()
+		try:
+			if len(self._codes_)>=self.maxsize and key not in self._codes_:
+				oldest=min(self._codes_.items(), key=lambda item: item[1][1])
+				del self._codes_[oldest[0]]
+			self._codes_[key]=[code, self._tick_]
+		finally:
+			self._lock_.release()
+		return code
+	
+	def stats(self):
+		return {'hits': self.hits, 'misses': self.misses,
+			'size': len(self._codes_), 'maxsize': self.maxsize}
+	
+	def clear(self):
+		self._lock_.acquire()
+		try: self._codes_.clear()
+		finally: self._lock_.release()
+
+codecache=CodeCache()
+
 class PythonEngine:
 	_id_=''
 	_vars_={}
 	_counter_=1
-	_lock_timeout_=30
+	_lock_timeout_=30	# seconds, None waits forever
+	_stream_timeout_=600	# seconds an unused stream is kept
 	
-	def __init__(self, debug=False, showExecTime=False):
+	def __init__(self, debug=False, showExecTime=False, lockTimeout=-1,
+		     processes=0):
 		self._debug_=debug
 		self._time_=showExecTime
-		self._lock_=threading.Event()
-		self._lock_.set()
+		if lockTimeout!=-1: self._lock_timeout_=lockTimeout
+		self._lock_=srpydecorators.ReadWriteLock()
+		# session handle: (globals, lock), None is the default session
+		self._sessions_={None: (self._vars_, self._lock_)}
+		self._sessions_lock_=threading.Lock()
+		# session: namespace version, bumped on every namespace change
+		self._versions_={}
+		# stream handle: [chunk iterator (stream_get) or StreamAssembler,
+		# session, last use time]
+		self._streams_={}
+		self._streams_lock_=threading.Lock()
 		self._tempdir_=tempfile.mkdtemp('PyEngineSandbox')
 		sys.path.append(self._tempdir_)
+		# worker processes for vexe and apply, started after the sandbox
+		# is in sys.path so installed modules can be imported by them
+		self._procpool_=None
+		self._processes_=processes
+		if processes>0:
+			import multiprocessing
+			self._procpool_=multiprocessing.Pool(processes)
 		for me in dir(self):
 			f=getattr(self, me)
 			if type(f)==types.InstanceType:
 				f.fself=self
+	
+	def _session_(self, session):
+		"Returns the (globals, lock) pair of a session"
+		try: return self._sessions_[session]
+		except KeyError: raise KeyError("unknown session %r" % (session,))
+	
+	def _globals_(self, session):
+		return self._session_(session)[0]
+	
+	def _touch_(self, session):
+		"Called when the session namespace changes, returns its new version"
+		self._versions_[session]=self._versions_.get(session, 0)+1
+		return self._versions_[session]
+	
+	@srpydecorators.BaseDecorator
+	def create_session(self):
+		"Creates a new isolated namespace, returns its handle"
+		import uuid
+		session=uuid.uuid4().hex
+		self._sessions_lock_.acquire()
+		try: self._sessions_[session]=({}, srpydecorators.ReadWriteLock())
+		finally: self._sessions_lock_.release()
+		return session
+	
+	@srpydecorators.BaseDecorator
+	def close_session(self, session):
+		"Deletes a namespace created by create_session"
+		if session is None: raise ValueError("the default session can't be closed")
+		self._sessions_lock_.acquire()
+		try:
+			self._session_(session)
+			del self._sessions_[session]
+			self._versions_.pop(session, None)
+			self._closeStreams_(session)
+		finally: self._sessions_lock_.release()
+	
+	@srpydecorators.BaseDecorator
+	def list_sessions(self):
+		"Returns the handles of the sessions created by create_session"
+		return [session for session in self._sessions_ if session is not None]
 			
-	@srpydecorators.ThreadSafeDecorator
-	def get(self, var_name):
+	@srpydecorators.ReadLockDecorator
+	def get(self, var_name, session=None):
 		"Get a variable from globals"
-		v=self._vars_[var_name]
-		return self._vars_[var_name]
+		return self._globals_(session)[var_name]
 	
 	@srpydecorators.ThreadSafeDecorator	
-	def set(self, var_name, value):
-		"Set a variable inside globals"
-		self._vars_[var_name]=value
+	def set(self, var_name, value, session=None):
+		"""Set a variable inside globals, large NumPy arrays and strings
+		arrive out of band straight into their own memory (Pyro.protocol)"""
+		self._globals_(session)[var_name]=value
+		return self._touch_(session)
 	
-	@srpydecorators.ThreadSafeDecorator	
-	def list(self):
+	@srpydecorators.ReadLockDecorator
+	def getmany(self, var_names, session=None):
+		"Get several variables from globals in a single call"
+		vars=self._globals_(session)
+		output={}
+		for var_name in var_names: output[var_name]=vars[var_name]
+		return output
+	
+	@srpydecorators.ThreadSafeDecorator
+	def setmany(self, vars, session=None):
+		"Set several variables inside globals in a single call"
+		self._globals_(session).update(vars)
+		return self._touch_(session)
+	
+	@srpydecorators.BaseDecorator
+	def copy_to(self, uri, var_names, session=None, peer_session=None):
+		"""Copies variables straight to the python engine at uri, one
+		pipelined set call per variable. The values are taken under the
+		read lock, which is released before connecting to the peer so
+		engines copying to each other do not wait for each other.
+		Returns the namespace version of the peer session"""
+		import Pyro.core, Pyro.errors
+		from srpyerror import SRPyLockTimeout
+		vars, lock = self._session_(session)
+		if not lock.acquire(False, self._lock_timeout_):
+			raise SRPyLockTimeout("copy_to could not lock the engine in %ss" % (
+				self._lock_timeout_))
+		try: values=[(var_name, vars[var_name]) for var_name in var_names]
+		finally: lock.release()
+		peer=Pyro.core.getProxyForURI(uri)
+		try:
+			results=peer._pipeline([('set', (var_name, value),
+						 {'session': peer_session})
+						for var_name, value in values])
+		finally:
+			peer._release()
+		for result in results:
+			if isinstance(result, Pyro.errors.PyroExceptionCapsule):
+				result.raiseEx()
+		if results: return results[-1]
+	
+	@srpydecorators.BaseDecorator
+	def relay(self, var_name, value, targets=[], fanout=2, session=None):
+		"""Sets a variable and forwards it to the python engines of targets,
+		a list of (uri, session) pairs, as a tree: the targets are split in
+		fanout subtrees and the first engine of each subtree relays the
+		value to the rest of it, fanout 1 makes a pipeline. An engine that
+		fails is skipped and its subtree is relayed from the next one.
+		Returns (namespace version, [((uri, session), version)] of the
+		targets that got the variable, [((uri, session), error)] of the
+		ones that did not)"""
+		import Pyro.core
+		version=self.set(var_name, value, session=session)
+		reached=[]
+		failed=[]
+		def forward(subtree):
+			while subtree:
+				target, rest = subtree[0], subtree[1:]
+				uri, peer_session = target
+				peer=Pyro.core.getProxyForURI(uri)
+				try:
+					peer_version, peer_reached, peer_failed = peer.relay(
+						var_name, value, rest, fanout, session=peer_session)
+				except Exception, x:
+					failed.append((target, "%s: %s" % (x.__class__.__name__, x)))
+					subtree=rest
+				else:
+					reached.append((target, peer_version))
+					reached.extend(peer_reached)
+					failed.extend(peer_failed)
+					return
+				finally:
+					peer._release()
+		fanout=max(1, fanout)
+		size=(len(targets)+fanout-1)//fanout
+		threads=[threading.Thread(target=forward, args=(targets[n:n+size],))
+			 for n in range(0, len(targets), max(1, size))]
+		for thread in threads: thread.start()
+		for thread in threads: thread.join()
+		return version, reached, failed
+	
+	def _stream_(self, handle):
+		try: entry=self._streams_[handle]
+		except KeyError: raise KeyError("unknown stream %r" % (handle,))
+		entry[2]=time.time()
+		return entry[0]
+	
+	def _openStream_(self, stream, session):
+		import uuid
+		handle=uuid.uuid4().hex
+		now=time.time()
+		self._streams_lock_.acquire()
+		try:
+			# drop the streams abandoned by their clients
+			for old, entry in self._streams_.items():
+				if now-entry[2]>self._stream_timeout_: del self._streams_[old]
+			self._streams_[handle]=[stream, session, now]
+		finally: self._streams_lock_.release()
+		return handle
+	
+	def _closeStreams_(self, session):
+		self._streams_lock_.acquire()
+		try:
+			for handle, entry in self._streams_.items():
+				if entry[1]==session: del self._streams_[handle]
+		finally: self._streams_lock_.release()
+	
+	@srpydecorators.ReadLockDecorator
+	def stream_get(self, var_name, chunksize=1<<20, session=None):
+		"""Opens a stream over a variable to be read with stream_read.
+		Returns (handle, kind, info): kind 'array' with info (dtype, shape),
+		'str' with info the size, or 'pickle' with info the pickled size"""
+		kind, info, chunks = _chunks(self._globals_(session)[var_name],
+					     chunksize)
+		return self._openStream_(chunks, session), kind, info
+	
+	@srpydecorators.BaseDecorator
+	def stream_read(self, handle):
+		"Returns the next chunk of a stream, None when it is exhausted"
+		for chunk in self._stream_(handle):
+			return chunk
+		self._streams_.pop(handle, None)
+		return None
+	
+	@srpydecorators.BaseDecorator
+	def stream_set(self, var_name, dtype=None, shape=None, session=None):
+		"""Opens a stream that assembles the chunks given to stream_write
+		into a variable, which is only set by stream_commit"""
+		self._session_(session)
+		return self._openStream_(StreamAssembler(var_name, dtype, shape),
+					 session)
+	
+	@srpydecorators.BaseDecorator
+	def stream_write(self, handle, chunk):
+		"Appends a chunk to a stream opened by stream_set"
+		self._stream_(handle).write(chunk)
+	
+	@srpydecorators.ThreadSafeDecorator
+	def stream_commit(self, handle, session=None):
+		"Sets the variable assembled by a stream and closes the stream"
+		assembler=self._stream_(handle)
+		self._globals_(session)[assembler.name]=assembler.value()
+		self._streams_.pop(handle, None)
+		return self._touch_(session)
+	
+	@srpydecorators.BaseDecorator
+	def stream_close(self, handle):
+		"Discards a stream that won't be read or committed"
+		self._streams_.pop(handle, None)
+	
+	@srpydecorators.ReadLockDecorator	
+	def list(self, session=None):
 		"Returns globals keys"
-		return self._vars_.keys()
+		return self._globals_(session).keys()
 	
 	@srpydecorators.ThreadSafeDecorator		
-	def exe(self, cmd):
+	def exe(self, cmd, session=None):
 		"Similar to exec"
-		exec cmd in self._vars_
+		exec codecache.compile(cmd, 'exec') in self._globals_(session)
+		return self._touch_(session)
 	
 	@srpydecorators.BaseDecorator
 	def vexe(self, cmd, get=[], **vars):
-		"Volatile exec, varibles will be deleted after execution"
-		exec cmd in vars
-		output={}
-		for var in get: output[var]=vars[var]
-		return output
+		"""Volatile exec, varibles will be deleted after execution,
+		runs on a worker process if the engine has a process pool"""
+		if self._procpool_ is not None:
+			return self._procpool_.apply(_vexe, (cmd, get, vars))
+		return _vexe(cmd, get, vars)
 	
-	@srpydecorators.ThreadSafeDecorator	
-	def eval(self, cmd):
+	@srpydecorators.BaseDecorator
+	def apply(self, func_name, args=(), kwds={}):
+		"""Calls a builtin or importable function given by its dotted name,
+		runs on a worker process if the engine has a process pool"""
+		if self._procpool_ is not None:
+			return self._procpool_.apply(_apply, (func_name, args, kwds))
+		return _apply(func_name, args, kwds)
+	
+	@srpydecorators.ReadLockDecorator	
+	def eval(self, cmd, session=None):
 		"Similar to eval"
-		return eval(cmd, self._vars_)
+		return eval(codecache.compile(cmd, 'eval'), self._globals_(session))
+
+	@srpydecorators.ReadLockDecorator
+	def call(self, func_name, args=(), kwds={}, session=None):
+		"""Calls a function of the namespace given by its dotted name, the
+		namespace version is bumped as the function may change it"""
+		vars=self._globals_(session)
+		names=func_name.split('.')
+		if names[0] in vars: func=vars[names[0]]
+		else:
+			import __builtin__
+			func=getattr(__builtin__, names[0])
+		for name in names[1:]: func=getattr(func, name)
+		try: return func(*args, **kwds)
+		finally: self._touch_(session)
+
+	@srpydecorators.ReadLockDecorator
+	def introspect(self, name, session=None):
+		"""Describes a dotted name of the namespace in a single call, returns
+		(kind, doc, value, namespace version) where kind is 'module',
+		'callable', 'value' or 'missing' and value is only set for 'value'"""
+		vars=self._globals_(session)
+		version=self._versions_.get(session, 0)
+		names=name.split('.')
+		try:
+			if names[0] in vars: obj=vars[names[0]]
+			else:
+				import __builtin__
+				obj=getattr(__builtin__, names[0])
+			for attr in names[1:]: obj=getattr(obj, attr)
+		except AttributeError:
+			return 'missing', None, None, version
+		if isinstance(obj, types.ModuleType):
+			return 'module', obj.__doc__, None, version
+		if hasattr(obj, '__call__'):
+			return 'callable', getattr(obj, '__doc__', None), None, version
+		return 'value', None, obj, version
 
 	@srpydecorators.ThreadSafeDecorator
-	def install(self, modname, modtxt):
+	def install(self, modname, modtxt, session=None):
 		"Install a module on a tempdir"
+		vars=self._globals_(session)
 		modfile=os.path.join(self._tempdir_, modname)
 		open(modfile, 'w').write(modtxt)
 		pymodname=os.path.splitext(modname)[0]
-		if self._vars_.has_key(pymodname):
-			self._vars_[pymodname]=reload(self._vars_[pymodname])
+		if vars.has_key(pymodname):
+			vars[pymodname]=reload(vars[pymodname])
+		return self._touch_(session)
 
-	@srpydecorators.ThreadSafeDecorator		
-	def isModuleInstance(self, varname):
+	@srpydecorators.ReadLockDecorator		
+	def isModuleInstance(self, varname, session=None):
 		"Returns true if the namespace variable is a module instance"
-		if varname in self._vars_:
-			return isinstance(self._vars_[varname], types.ModuleType)
+		vars=self._globals_(session)
+		if varname in vars:
+			return isinstance(vars[varname], types.ModuleType)
 		else:
 			return False
 	
 	@srpydecorators.ThreadSafeDecorator
-	def clear(self):
+	def clear(self, session=None):
 		"Deletes items of the current namespace"
-		self._vars_.clear()
+		self._globals_(session).clear()
+		return self._touch_(session)
 	
 	@srpydecorators.BaseDecorator	
 	def ping(self):
@@ -107,14 +411,19 @@ class PythonEngine:
 		return "pong"
 
 	@srpydecorators.BaseDecorator
-	def isBusy(self):
+	def isBusy(self, session=None):
 		"Returns true if the PythonEngine is busy (locked)"
-		return not self._lock_.isSet()
+		return self._session_(session)[1].isLocked()
 
 	@srpydecorators.BaseDecorator
-	def wait(self, timeout=None):
+	def wait(self, timeout=None, session=None):
 		"Waits for PythonEngine to stop being busy"
-		self._lock_.wait(timeout)
+		self._session_(session)[1].waitIdle(timeout)
+
+	@srpydecorators.BaseDecorator
+	def cacheStats(self):
+		"Returns hits, misses and size of the compiled code cache"
+		return codecache.stats()
 
 	@srpydecorators.BaseDecorator	
 	def getID(self):
@@ -130,7 +439,86 @@ class PythonEngine:
 		info['Python Version'] = platform.python_version()
 		info['Python Compiler'] = platform.python_compiler()
 		info['PythonEngine ID'] = (self._id_, platform.node())
+		info['Worker Processes'] = self._processes_
 		return info
+	
+	def _shutdown_(self):
+		self._streams_.clear()
+		if self._procpool_ is not None:
+			self._procpool_.terminate()
+			self._procpool_=None
+
+def _chunks(value, chunksize):
+	"Returns kind, info and a chunk iterator for stream_get"
+	numpy=sys.modules.get('numpy')
+	if numpy is not None and isinstance(value, numpy.ndarray) \
+	   and not value.dtype.hasobject:
+		flat=numpy.ascontiguousarray(value).reshape(-1)
+		step=max(1, chunksize//max(1, flat.itemsize))
+		chunks=(flat[i:i+step] for i in xrange(0, len(flat), step))
+		return 'array', (value.dtype.str, value.shape), chunks
+	if type(value) is str: kind='str'
+	else:
+		import cPickle
+		value=cPickle.dumps(value, 2)
+		kind='pickle'
+	chunks=(value[i:i+chunksize] for i in xrange(0, len(value), chunksize))
+	return kind, len(value), chunks
+
+class StreamAssembler:
+	"""Builds a variable from chunks: an array of the given dtype, filled in
+	place when the shape is known, otherwise the str joining the chunks"""
+	
+	def __init__(self, name, dtype=None, shape=None):
+		self.name=name
+		self.chunks=[]
+		self.array=None
+		self.dtype=dtype
+		if dtype is not None and shape is not None:
+			import numpy
+			self.array=numpy.empty(shape, dtype)
+			self.offset=0
+	
+	def write(self, chunk):
+		if self.array is None:
+			if self.dtype is not None:
+				import numpy
+				chunk=numpy.array(chunk, self.dtype).reshape(-1)
+			self.chunks.append(chunk)
+			return
+		import numpy
+		chunk=numpy.asarray(chunk, self.array.dtype).reshape(-1)
+		flat=self.array.reshape(-1)
+		if self.offset+len(chunk)>len(flat):
+			raise ValueError("stream %s overflows shape %s" % (self.name,
+							   self.array.shape))
+		flat[self.offset:self.offset+len(chunk)]=chunk
+		self.offset+=len(chunk)
+	
+	def value(self):
+		if self.array is not None:
+			if self.offset!=self.array.size:
+				raise ValueError("stream %s got %d of %d items" % (self.name,
+						 self.offset, self.array.size))
+			return self.array
+		if self.dtype is None: return ''.join(self.chunks)
+		import numpy
+		if not self.chunks: return numpy.empty(0, self.dtype)
+		return numpy.concatenate(self.chunks)
+
+def _vexe(cmd, get, vars):
+	exec codecache.compile(cmd, 'exec') in vars
+	output={}
+	for var in get: output[var]=vars[var]
+	return output
+
+def _apply(func_name, args, kwds):
+	module, dot, name = func_name.rpartition('.')
+	if module: func=getattr(__import__(module, {}, {}, [name]), name)
+	else:
+		import __builtin__
+		func=getattr(__builtin__, name)
+	return func(*args, **kwds)
 
 class PythonEngineServer:
 	def __init__(self, urifile=None, *args, **kwds):
@@ -153,3 +541,4 @@ class PythonEngineServer:
 		
 	def stop(self):
 		self.daemon.shutdown(True)
+		self.pyeng._shutdown_()
@@ -0,0 +1,277 @@
+# Simple Remote Python: http://code.google.com/p/srpy/
+# Copyright (c) 2009, Ricardo Henriques
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the author nor the names of its contributors
+#      may be used to endorse or promote products derived from this software
+#      without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF
+# THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Supervision of the PythonEngine(s) of an EngBox: heartbeats, health scores
+and respawn of crashed engines
+"""
+
+__docformat__="epytext"
+
+import threading, time
+from collections import deque
+
+class EngineHealth:
+    """
+    Rolling heartbeat statistics of a PythonEngine, kept by a L{Supervisor}
+    in the 'health' attribute of each PythonEngine it watches.
+    """
+
+    def __init__(self, window=20):
+        """
+        @param window: number of recent heartbeats the statistics are
+        computed on
+        @type window: int
+        """
+        self.latencies=deque(maxlen=window)
+        self.results=deque(maxlen=window)
+        self.failures=0
+        self.respawns=0
+        self.lastSeen=None
+        self.lastError=None
+
+    def record(self, latency=None, error=None):
+        """
+        Records the outcome of a heartbeat, either its round trip time or
+        the exception raised.
+        
+        @rtype: None
+        """
+        if error is None:
+            self.latencies.append(latency)
+            self.results.append(True)
+            self.failures=0
+            self.lastSeen=time.time()
+        else:
+            self.results.append(False)
+            self.failures+=1
+            self.lastError=error
+
+    def latency(self):
+        """
+        Returns the mean round trip time of the recent heartbeats in
+        seconds, None if none succeeded.
+        
+        @rtype: float
+        """
+        if not self.latencies: return None
+        return sum(self.latencies)/len(self.latencies)
+
+    def errorRate(self):
+        """
+        Returns the fraction of the recent heartbeats that failed.
+        
+        @rtype: float
+        """
+        if not self.results: return 0.0
+        return self.results.count(False)/float(len(self.results))
+
+    def score(self):
+        """
+        Returns the expected seconds per successful call, the mean latency
+        divided by the success rate: lower is better, infinite when the
+        recent heartbeats all failed and 0 when there is no data yet.
+        
+        @rtype: float
+        """
+        success=1-self.errorRate()
+        if success==0: return float('inf')
+        return (self.latency() or 0.0)/success
+
+    def __repr__(self):
+        return "EngineHealth(score=%.6f, errorRate=%.2f, failures=%d, respawns=%d)" % (
+            self.score(), self.errorRate(), self.failures, self.respawns)
+
+class Supervisor:
+    """
+    Watches the PythonEngine(s) of an EngBox from a background thread:
+    pings them all at once every interval seconds, keeps an L{EngineHealth}
+    in the 'health' attribute of each one and replaces crashed engines by
+    new ones in the same EngBox position.
+    
+    An engine busy in a long call that holds the GIL (eg: a big numpy
+    operation) can't answer heartbeats either, and a respawn loses its
+    namespace, so engines whose subprocess is still running are only
+    respawned after being silent for grace seconds.
+    """
+
+    def __init__(self, engbox, spawn=None, interval=5, timeout=5,
+                 maxFailures=3, grace=300, window=20, onRespawn=None):
+        """
+        Example:
+        
+        >>> import srpy
+        >>> engbox = srpy.newEngBox(4)
+        >>> supervisor = srpy.Supervisor(engbox)
+        >>> supervisor.start()
+        >>> engbox[0].health.score()
+        
+        @param engbox: PythonEngine(s) to watch, the subprocess in the
+        'proc' attribute of each one (see L{newEngBox <srpyapp.newEngBox>})
+        is watched as well and replaced along with its engine
+        @type engbox: L{EngBox <srpyclient.EngBox>}
+        @param spawn: function returning the (uri, subprocess) of a new
+        engine, by default L{newSubEngine <srpyapp.newSubEngine>} if the
+        engines have a 'proc', otherwise dead engines are not replaced
+        @type spawn: callable
+        @param interval: seconds between heartbeats
+        @type interval: float
+        @param timeout: seconds a heartbeat waits for the answers
+        @type timeout: float
+        @param maxFailures: consecutive failed heartbeats after which an
+        engine is respawned, if it was also silent for grace seconds, an
+        engine whose subprocess exited is respawned at once
+        @type maxFailures: int
+        @param grace: seconds without an answer before an engine that may
+        still be running (its subprocess did not exit or is unknown) is
+        respawned
+        @type grace: float
+        @param window: number of heartbeats the health statistics use
+        @type window: int
+        @param onRespawn: called as onRespawn(old, new) with both
+        PythonEngine(s) after a respawn
+        @type onRespawn: callable
+        """
+        if spawn is None and \
+           [pyeng for pyeng in engbox if getattr(pyeng, 'proc', None)]:
+            try: from srpyapp import newSubEngine
+            except ImportError: from srpy.srpyapp import newSubEngine
+            spawn=newSubEngine
+        self.engbox=engbox
+        self.spawn=spawn
+        self.interval=interval
+        self.timeout=timeout
+        self.maxFailures=maxFailures
+        self.grace=grace
+        self.window=window
+        self.onRespawn=onRespawn
+        self._stop=threading.Event()
+        self._thread=None
+        self._started=time.time()
+
+    def health(self, pyeng):
+        """
+        Returns the L{EngineHealth} of a PythonEngine, creating it if needed.
+        
+        @rtype: L{EngineHealth}
+        """
+        if getattr(pyeng, 'health', None) is None:
+            pyeng.health=EngineHealth(self.window)
+        return pyeng.health
+
+    def check(self):
+        """
+        Runs one round of heartbeats and respawns the engines that crashed.
+        
+        @return: PythonEngine(s) that were respawned, (old, new) pairs
+        @rtype: list
+        """
+        from srpyclient import _heartbeats
+        pyengs=self.engbox.toList()[:]
+        respawned=[]
+        for n, result in enumerate(_heartbeats(pyengs, self.timeout)):
+            health=self.health(pyengs[n])
+            if isinstance(result, Exception): health.record(error=result)
+            else: health.record(latency=result)
+            proc=getattr(pyengs[n], 'proc', None)
+            exited=proc is not None and proc.poll() is not None
+            silent=time.time()-(health.lastSeen or self._started)
+            if self.spawn is not None and (exited or (
+                health.failures>=self.maxFailures and silent>=self.grace)):
+                new=self.respawn(pyengs[n])
+                if new is not None: respawned.append((pyengs[n], new))
+        return respawned
+
+    def respawn(self, pyeng):
+        """
+        Replaces a PythonEngine of the EngBox by a new one, started with the
+        spawn function. The new engine keeps the name, group and health of
+        the old one.
+        
+        @return: the new PythonEngine, None if pyeng is not in the EngBox or
+        the new engine could not be started
+        @rtype: L{PythonEngine <srpyclient.PythonEngine>}
+        """
+        import Pyro.util
+        from srpyclient import PythonEngine
+        index=None
+        for n, engine in enumerate(self.engbox):
+            if engine is pyeng: index=n
+        if index is None: return None
+        old=getattr(pyeng, 'proc', None)
+        if old is not None:
+            try:
+                if old.poll() is None: old.kill()
+            except OSError:
+                pass
+        try:
+            uri, proc = self.spawn()
+            new=PythonEngine(uri.strip(), name=pyeng.name, group=pyeng.group,
+                             pool=pyeng.pool, connections=pyeng.connections)
+        except Exception, x:
+            print ''.join(Pyro.util.getPyroTraceback(x))
+            return None
+        new.health=self.health(pyeng)
+        new.health.failures=0
+        new.health.respawns+=1
+        new.proc=proc
+        self.engbox[index]=new
+        # the EngBox list of subprocesses, see newEngBox
+        procs=getattr(self.engbox, 'procs', None)
+        if procs is not None:
+            if old in procs: procs[procs.index(old)]=proc
+            else: procs.append(proc)
+        if self.onRespawn is not None: self.onRespawn(pyeng, new)
+        return new
+
+    def start(self):
+        """
+        Starts the heartbeats on a background thread.
+        
+        @rtype: None
+        """
+        self._stop.clear()
+        self._thread=threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the heartbeats, waiting for the running round to finish.
+        
+        @rtype: None
+        """
+        self._stop.set()
+        if self._thread is not None: self._thread.join()
+        self._thread=None
+
+    def _run(self):
+        import Pyro.util
+        while not self._stop.isSet():
+            try: self.check()
+            except Exception, x:
+                print ''.join(Pyro.util.getPyroTraceback(x))
+            self._stop.wait(self.interval)